@@ -0,0 +1,170 @@
+"""
+Batched data augmentation for training: random rotations, shifts, shears,
+zooms and flips, like the ones of keras ImageDataGenerator (with the same
+parameters, drawn from the same distributions, and turned into the same
+affine transforms), but drawn for a whole batch at once as numpy arrays and
+applied to all its samples and channels in a single pass, instead of one
+sample (and one channel) at a time.
+
+Transforms are drawn from a numpy random generator, so a batch can be
+augmented in any process, and a seeded generator always gives the same
+transforms.
+"""
+import numpy as np
+
+
+class Augmentation:
+    """
+    Random transforms of float batches of (n, height, width, channels)
+    pictures.
+    Ranges follow ImageDataGenerator: rotation and shear in degrees, shifts
+    as fractions of the picture size (or pixels, if 1 or more), and zoom
+    factors between 1 - zoom_range and 1 + zoom_range.
+    """
+    def __init__(self, rotation_range=0, width_shift_range=0,
+                 height_shift_range=0, shear_range=0, zoom_range=0,
+                 horizontal_flip=False, vertical_flip=False):
+        if np.isscalar(zoom_range):
+            zoom_range = (1 - zoom_range, 1 + zoom_range)
+
+        self.rotation_range = rotation_range
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.shear_range = shear_range
+        self.zoom_range = tuple(zoom_range)
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+
+    def random_transforms(self, count, height, width, random_generator):
+        """
+        Draw the parameters of the transforms of count pictures, as a dict of
+        arrays (with the names ImageDataGenerator uses for them).
+        """
+        def uniform(limit):
+            return random_generator.uniform(-limit, limit, count)
+
+        def shift(shift_range, size):
+            shifts = uniform(shift_range)
+            if shift_range < 1:
+                shifts *= size
+            return shifts
+
+        return {
+            'theta': uniform(self.rotation_range),
+            # tx moves rows and ty moves columns, as in ImageDataGenerator
+            'tx': shift(self.height_shift_range, height),
+            'ty': shift(self.width_shift_range, width),
+            'shear': uniform(self.shear_range),
+            'zx': random_generator.uniform(*self.zoom_range, count),
+            'zy': random_generator.uniform(*self.zoom_range, count),
+            'flip_horizontal': ((random_generator.random(count) < 0.5) &
+                                self.horizontal_flip),
+            'flip_vertical': ((random_generator.random(count) < 0.5) &
+                              self.vertical_flip),
+        }
+
+    def apply(self, inputs, random_generator=None):
+        """
+        Augment a batch of pictures with random transforms.
+        """
+        if random_generator is None:
+            random_generator = np.random.default_rng()
+
+        count, height, width, _ = inputs.shape
+        transforms = self.random_transforms(count, height, width,
+                                            random_generator)
+        return apply_transforms(inputs, transforms)
+
+
+def transform_matrices(transforms, height, width):
+    """
+    Build the (n, 3, 3) matrices of some transforms, mapping (row, column)
+    coordinates of the transformed pictures to coordinates of the original
+    ones, as ImageDataGenerator does (rotation, then shift, shear and zoom,
+    around the center of the picture).
+    """
+    theta = np.deg2rad(transforms['theta'])
+    shear = np.deg2rad(transforms['shear'])
+    count = len(theta)
+
+    def matrices(rows):
+        stacked = np.zeros((count, 3, 3))
+        for row_number, row in enumerate(rows):
+            for column_number, value in enumerate(row):
+                stacked[:, row_number, column_number] = value
+        return stacked
+
+    zeros = np.zeros(count)
+    ones = np.ones(count)
+    rotation = matrices([[np.cos(theta), -np.sin(theta), zeros],
+                         [np.sin(theta), np.cos(theta), zeros],
+                         [zeros, zeros, ones]])
+    shift = matrices([[ones, zeros, transforms['tx']],
+                      [zeros, ones, transforms['ty']],
+                      [zeros, zeros, ones]])
+    shear = matrices([[ones, -np.sin(shear), zeros],
+                      [zeros, np.cos(shear), zeros],
+                      [zeros, zeros, ones]])
+    zoom = matrices([[transforms['zx'], zeros, zeros],
+                     [zeros, transforms['zy'], zeros],
+                     [zeros, zeros, ones]])
+
+    # same (slightly off) center as keras
+    center_x = height / 2 + 0.5
+    center_y = width / 2 + 0.5
+    offset = np.array([[1, 0, center_x], [0, 1, center_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -center_x], [0, 1, -center_y], [0, 0, 1]])
+
+    return offset @ rotation @ shift @ shear @ zoom @ reset
+
+
+def apply_transforms(inputs, transforms):
+    """
+    Apply some transforms to a (n, height, width, channels) float batch of
+    pictures, with bilinear interpolation, repeating the edges of the
+    pictures where the transforms go outside of them, and then flipping.
+    """
+    count, height, width, _ = inputs.shape
+    matrices = transform_matrices(transforms, height, width)
+
+    rows, columns = np.meshgrid(np.arange(height), np.arange(width),
+                                indexing='ij')
+    coordinates = np.stack([rows.ravel(), columns.ravel(),
+                            np.ones(height * width)])
+    source_rows, source_columns = (matrices[:, :2] @ coordinates).transpose(
+        1, 0, 2)
+
+    source_rows = np.clip(source_rows, 0, height - 1)
+    source_columns = np.clip(source_columns, 0, width - 1)
+    from_rows = np.floor(source_rows)
+    from_columns = np.floor(source_columns)
+    row_weights = (source_rows - from_rows).astype(np.float32)[
+        ..., np.newaxis]
+    column_weights = (source_columns - from_columns).astype(np.float32)[
+        ..., np.newaxis]
+
+    # gather the 4 neighbours of every source pixel from the flattened batch
+    from_rows = from_rows.astype(np.intp)
+    from_columns = from_columns.astype(np.intp)
+    first_pixels = (np.arange(count) * height * width)[:, np.newaxis]
+    from_offsets = first_pixels + from_rows * width
+    to_offsets = first_pixels + np.minimum(from_rows + 1, height - 1) * width
+    to_columns = np.minimum(from_columns + 1, width - 1)
+    pixels = inputs.reshape(count * height * width, -1)
+
+    def gather(offsets, columns):
+        return np.take(pixels, offsets + columns, axis=0)
+
+    top = gather(from_offsets, from_columns)
+    top += (gather(from_offsets, to_columns) - top) * column_weights
+    bottom = gather(to_offsets, from_columns)
+    bottom += (gather(to_offsets, to_columns) - bottom) * column_weights
+    top += (bottom - top) * row_weights
+    outputs = top.reshape(inputs.shape)
+
+    flip_horizontal = transforms['flip_horizontal']
+    outputs[flip_horizontal] = outputs[flip_horizontal, :, ::-1]
+    flip_vertical = transforms['flip_vertical']
+    outputs[flip_vertical] = outputs[flip_vertical, ::-1]
+
+    return outputs
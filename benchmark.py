@@ -0,0 +1,273 @@
+"""
+Benchmark the hot paths of the project over a synthetic corpus, writing the
+results (wall time, throughput and peak memory of each stage) as json, so runs
+can be compared across commits and corpus sizes.
+
+Each stage runs in its own python process, pointed to the corpus with the
+MINIATURES_DATA_DIR env var.
+
+Usage:
+    benchmark.py [options]
+    benchmark.py run-stage STAGE RESULT_PATH
+
+Options:
+    --corpus-dir=DIR        where to create the synthetic corpus (a temporary
+                            dir by default). An existing corpus is reused.
+    --miniatures=N          amount of miniatures in the csv [default: 16500].
+    --pictures=N            how many of them get a picture file [default: 500].
+    --tagged=N              how many of the ones with pictures get tagged
+                            objects [default: 300].
+    --picture-size=N        longest side of the pictures, in pixels
+                            [default: 1200].
+    --stages=STAGES         comma separated list of stages to run (all of them
+                            by default).
+    --output=PATH           where to write the results
+                            [default: benchmark_results.json].
+"""
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import attr
+from docopt import docopt
+
+from core import Miniature
+import download_pictures
+import generate_dataframe
+import generate_set
+from generate_set import miniatures_with_info_about
+import settings
+import synthetic_corpus
+
+
+BENCHMARK_OBJECT = 'sword'
+BENCHMARK_NEGATIVES_RATIO = 5
+BENCHMARK_PICTURE_SIZE = 100
+
+
+def stage_metadata_cold():
+    if settings.METADATA_INDEX_PATH.exists():
+        settings.METADATA_INDEX_PATH.unlink()
+    return len(list(Miniature.all()))
+
+
+def stage_metadata():
+    return len(list(Miniature.all()))
+
+
+def stage_load_objects():
+    if settings.OBJECTS_DB_PATH.exists():
+        settings.OBJECTS_DB_PATH.unlink()
+
+    miniatures = list(Miniature.all())
+    for miniature in miniatures:
+        miniature.load_objects()
+    return len(miniatures)
+
+
+def stage_miniatures_with_info_about():
+    return len(miniatures_with_info_about(BENCHMARK_OBJECT))
+
+
+def run_generate_set(workers):
+    set_path = settings.OBJECTS_PICTURES_SETS_DIR / BENCHMARK_OBJECT
+    if set_path.exists():
+        shutil.rmtree(str(set_path))
+
+    generate_set.generate(BENCHMARK_OBJECT, BENCHMARK_NEGATIVES_RATIO,
+                          workers=workers, seed=0)
+    return len(list(set_path.glob('*/*.jpg')))
+
+
+def stage_generate_set():
+    return run_generate_set(workers=None)
+
+
+def stage_generate_set_pool():
+    return run_generate_set(workers=0)
+
+
+def run_dataframe(workers):
+    set_path = settings.OBJECTS_PICTURES_SETS_DIR / BENCHMARK_OBJECT
+    if not set_path.exists():
+        run_generate_set(workers=0)
+
+    # start from scratch, instead of reusing the output of a previous run
+    path = generate_dataframe.dataframe_path(BENCHMARK_OBJECT,
+                                             BENCHMARK_PICTURE_SIZE)
+    if path.exists():
+        path.unlink()
+
+    generate_dataframe.generate(BENCHMARK_OBJECT, BENCHMARK_PICTURE_SIZE,
+                                workers)
+    return len(generate_dataframe.set_pictures(BENCHMARK_OBJECT))
+
+
+def stage_dataframe():
+    return run_dataframe(workers=None)
+
+
+def stage_dataframe_pool():
+    return run_dataframe(workers=0)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def stage_download():
+    """
+    Download the corpus pictures from a local http server, into a temporary
+    dir (only the miniatures that have a picture are listed in the csv).
+    """
+    with tempfile.TemporaryDirectory() as download_dir:
+        download_dir = Path(download_dir)
+        pictures = {path.name for path in settings.PICTURES_DIR.glob('*.jpg')}
+
+        metadata_path = download_dir / 'miniatures_metadata.csv'
+        with settings.METADATA_CSV_PATH.open() as source, \
+                metadata_path.open('w') as destination:
+            for line in source:
+                fields = line.split(',')
+                if len(fields) > 2 and fields[2].strip() in pictures:
+                    destination.write(line)
+
+        handler = partial(QuietHandler, directory=str(settings.PICTURES_DIR))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        settings.PICTURE_URL = 'http://127.0.0.1:{}/{{}}'.format(
+            server.server_address[1])
+        settings.METADATA_CSV_PATH = metadata_path
+        settings.METADATA_INDEX_PATH = download_dir / 'metadata.idx'
+        settings.PICTURES_DIR = download_dir / 'pictures'
+        settings.DOWNLOAD_MANIFEST_PATH = download_dir / 'manifest.json'
+        settings.PICTURES_DIR.mkdir()
+
+        try:
+            stats = download_pictures.download_pending_pictures()
+        finally:
+            server.shutdown()
+
+    return stats.downloaded
+
+
+STAGES = {
+    'metadata_cold': stage_metadata_cold,
+    'metadata': stage_metadata,
+    'load_objects': stage_load_objects,
+    'miniatures_with_info_about': stage_miniatures_with_info_about,
+    'generate_set': stage_generate_set,
+    'generate_set_pool': stage_generate_set_pool,
+    'dataframe': stage_dataframe,
+    'dataframe_pool': stage_dataframe_pool,
+    'download': stage_download,
+}
+
+
+def run_stage(stage_name, result_path):
+    """
+    Run a single stage in this process, and save its measurements.
+    """
+    started_at = time.perf_counter()
+    items = STAGES[stage_name]()
+    wall_time = time.perf_counter() - started_at
+
+    result = {
+        'stage': stage_name,
+        'wall_time': wall_time,
+        'items': items,
+        'throughput': items / wall_time if wall_time else None,
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    with open(result_path, 'w') as result_file:
+        json.dump(result, result_file)
+
+
+def current_commit():
+    """
+    The git commit of the code being benchmarked, if available.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(Path(__file__).parent),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(corpus_dir, spec, stage_names):
+    """
+    Run the stages over the corpus (creating it if needed), each one in its
+    own process, and return all the results.
+    """
+    corpus_dir = Path(corpus_dir)
+    if not (corpus_dir / 'miniatures_metadata.csv').exists():
+        print('Generating synthetic corpus in', corpus_dir, '...')
+        synthetic_corpus.generate(corpus_dir, spec)
+
+    environment = dict(os.environ, MINIATURES_DATA_DIR=str(corpus_dir))
+    results = []
+    for stage_name in stage_names:
+        print('Running', stage_name, '...', end=' ', flush=True)
+        with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+            subprocess.run(
+                [sys.executable, str(Path(__file__).resolve()),
+                 'run-stage', stage_name, result_file.name],
+                env=environment, check=True, stdout=subprocess.DEVNULL)
+            result = json.load(result_file)
+
+        print('{:.3f}s'.format(result['wall_time']))
+        results.append(result)
+
+    return {
+        'commit': current_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'corpus': attr.asdict(spec),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+
+    if opts['run-stage']:
+        run_stage(opts['STAGE'], opts['RESULT_PATH'])
+    else:
+        spec = synthetic_corpus.CorpusSpec(
+            miniatures=int(opts['--miniatures']),
+            pictures=int(opts['--pictures']),
+            tagged=int(opts['--tagged']),
+            picture_size=int(opts['--picture-size']),
+        )
+
+        stage_names = list(STAGES)
+        if opts['--stages']:
+            stage_names = opts['--stages'].split(',')
+
+        if opts['--corpus-dir']:
+            report = benchmark(opts['--corpus-dir'], spec, stage_names)
+        else:
+            with tempfile.TemporaryDirectory() as corpus_dir:
+                report = benchmark(corpus_dir, spec, stage_names)
+
+        with open(opts['--output'], 'w') as output_file:
+            json.dump(report, output_file, indent=2)
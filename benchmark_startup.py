@@ -0,0 +1,113 @@
+"""
+Benchmark the cold start of the commands of miniatures.py, each one measured
+in fresh python processes: the time to show its help (which parses its
+arguments, but shouldn't import anything heavy), and the time to import its
+module, with the slowest imports found by python -X importtime.
+
+Usage:
+    benchmark_startup.py [options]
+
+Options:
+    --runs=N                how many times to run each measurement (the median
+                            is reported) [default: 5].
+    --max-time=SECONDS      fail if showing the help of any command takes
+                            longer than this.
+    --output=PATH           where to write the results
+                            [default: startup_results.json].
+"""
+import json
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+from miniatures import COMMANDS
+
+
+ROOT_DIR = Path(__file__).resolve().parent
+
+
+def run_time(arguments, runs):
+    """
+    Median wall time of running python with some arguments.
+    """
+    times = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=str(ROOT_DIR),
+                       check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started_at)
+    return statistics.median(times)
+
+
+def slowest_imports(module_name, count=5):
+    """
+    The packages (with their cumulative time, in seconds) that take the
+    longest to import when importing a module.
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import {}'.format(module_name)],
+        cwd=str(ROOT_DIR), check=True, stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+    packages = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, imported = line.split('|')
+            if not cumulative.strip().isdigit():
+                continue
+
+            # nested imports are indented, and listed before their parents,
+            # so the last line of a package is the one that includes all
+            # its submodules
+            package = imported.strip().split('.')[0]
+            packages[package] = int(cumulative) / 1e6
+
+    for ignored in (module_name, 'site', 'encodings'):
+        packages.pop(ignored, None)
+
+    return sorted(packages.items(), key=lambda item: item[1],
+                  reverse=True)[:count]
+
+
+def benchmark(runs):
+    interpreter_time = run_time(['-c', 'pass'], runs)
+    results = []
+    for command, module_name in COMMANDS.items():
+        print('Measuring', command, '...', end=' ', flush=True)
+        result = {
+            'command': command,
+            'help_time': run_time(['miniatures.py', command, '--help'], runs),
+            'import_time': run_time(['-c', 'import {}'.format(module_name)],
+                                    runs),
+            'slowest_imports': slowest_imports(module_name),
+        }
+        print('help {:.3f}s, import {:.3f}s'.format(result['help_time'],
+                                                    result['import_time']))
+        results.append(result)
+
+    return {
+        'python': sys.version,
+        'interpreter_time': interpreter_time,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    report = benchmark(int(opts['--runs']))
+
+    with open(opts['--output'], 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    max_help_time = opts['--max-time']
+    if max_help_time is not None:
+        slow = [result['command'] for result in report['results']
+                if result['help_time'] > float(max_help_time)]
+        if slow:
+            sys.exit('Too slow to start: {}'.format(', '.join(slow)))
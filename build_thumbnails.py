@@ -0,0 +1,69 @@
+"""
+Build the thumbnails pyramid of all the downloaded miniatures pictures (only
+the pyramids that are missing, or whose original changed, are built, so it's
+able to resume after an incomplete run).
+
+Usage:
+    build_thumbnails.py [--workers=WORKERS]
+
+Options:
+    --workers=WORKERS   build thumbnails in that many processes (defaults to
+                        one per cpu).
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from docopt import docopt
+
+from core import Miniature
+from thumbnails import build_pyramid
+
+
+def build_miniature_thumbnails(picture_path, file_name):
+    """
+    Build the thumbnails of a picture, returning how many were built (None if
+    the pyramid was current), and the error if it fails.
+    """
+    try:
+        return build_pyramid(picture_path, file_name), None
+    except Exception as err:
+        return 0, err
+
+
+def build_all_thumbnails(workers=None):
+    """
+    Build the missing or outdated pyramids of all the downloaded pictures, in
+    a pool of processes.
+    """
+    miniatures = [miniature for miniature in Miniature.all()
+                  if miniature.picture_path.exists()]
+
+    print('Building thumbnails of', len(miniatures), 'pictures...')
+    built = current = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(build_miniature_thumbnails,
+                               [m.picture_path for m in miniatures],
+                               [m.file_name for m in miniatures],
+                               chunksize=16)
+        for miniature, (count, err) in zip(miniatures, results):
+            if count is None:
+                current += 1
+            else:
+                built += count
+            if err is not None:
+                failed += 1
+                print(miniature, 'failed:', err)
+
+    print('Built', built, 'thumbnails,', current, 'pictures were up to date,',
+          failed, 'pictures failed')
+
+
+def run(opts):
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
+
+    build_all_thumbnails(workers)
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
@@ -1,21 +1,57 @@
+import hashlib
 import json
+import sys
+import time
 from pathlib import Path
 
 import attr
 from PIL import Image
-import requests
 
+import metadata_index
+import objects_store
 import settings
+import thumbnails
 
 
-@attr.s
+def objects_path(miniature_id):
+    """
+    Path of the json file with the tagged objects of a miniature.
+    """
+    return settings.OBJECTS_DIR / '{}.json'.format(miniature_id)
+
+
+def save_raw_objects(miniature_id, raw_objects):
+    """
+    Save the serialized tagged objects of a miniature into its json file
+    (atomically, so an interrupted write doesn't corrupt it), and update the
+    objects store.
+    """
+    path = objects_path(miniature_id)
+    partial_path = path.with_name(path.name + '.part')
+    with partial_path.open('w') as objects_file:
+        json.dump(raw_objects, objects_file)
+    partial_path.replace(path)
+
+    objects_store.get().save(miniature_id, raw_objects,
+                             path.stat().st_mtime_ns)
+
+
+def intern_tags(tags):
+    """
+    Store tags as a tuple of interned strings (the same few thousand tags are
+    shared by all the miniatures).
+    """
+    return tuple(sys.intern(tag) for tag in tags)
+
+
+@attr.s(slots=True)
 class Miniature:
     manuscript_id = attr.ib()
     miniature_id = attr.ib()
     file_name = attr.ib()
     start_year = attr.ib()
     end_year = attr.ib()
-    tags = attr.ib()
+    tags = attr.ib(converter=intern_tags)
     objects = attr.ib(init=False, default=attr.Factory(list))
     picture = attr.ib(init=False, default=None)
 
@@ -25,22 +61,75 @@ class Miniature:
 
     @property
     def objects_path(self):
-        return settings.OBJECTS_DIR / '{}.json'.format(self.miniature_id)
+        return objects_path(self.miniature_id)
 
-    def download_picture(self):
+    def download_picture(self, session=None, etag=None, last_modified=None):
         """
-        Download the picture file.
+        Download the picture file. The body is streamed into a temporary file
+        that is only renamed into place once complete, and failed attempts are
+        retried with exponential backoff.
+
+        With the etag or last modified date of the current file, the request
+        is conditional, and None is returned if the picture didn't change.
+        Otherwise returns the size, sha1 and cache validators of the new file.
         """
-        try:
-            url = settings.PICTURE_URL.format(self.file_name)
-            response = requests.get(url)
-            with self.picture_path.open("wb") as picture_file:
-                picture_file.write(response.content)
-        except Exception as err:
-            # clean possibly broken file
-            if self.picture_path.exists():
-                self.picture_path.unlink()
-            raise
+        # only needed here, importing it lazily makes every other command
+        # start faster
+        import requests
+
+        if session is None:
+            session = requests
+
+        url = settings.PICTURE_URL.format(self.file_name)
+        partial_path = self.picture_path.with_name(self.file_name + '.part')
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(settings.DOWNLOAD_RETRIES + 1):
+            try:
+                with session.get(url, stream=True, headers=headers,
+                                 timeout=settings.DOWNLOAD_TIMEOUT) as response:
+                    if response.status_code == 304:
+                        return None
+                    response.raise_for_status()
+
+                    size = 0
+                    content_hash = hashlib.sha1()
+                    with partial_path.open('wb') as picture_file:
+                        for chunk in response.iter_content(
+                                settings.DOWNLOAD_CHUNK_SIZE):
+                            picture_file.write(chunk)
+                            content_hash.update(chunk)
+                            size += len(chunk)
+
+                partial_path.replace(self.picture_path)
+                return {
+                    'size': size,
+                    'sha1': content_hash.hexdigest(),
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }
+            except requests.RequestException as err:
+                # clean possibly broken file
+                if partial_path.exists():
+                    partial_path.unlink()
+
+                # client errors won't go away by retrying
+                response = getattr(err, 'response', None)
+                client_error = (response is not None and
+                                400 <= response.status_code < 500)
+                if client_error or attempt == settings.DOWNLOAD_RETRIES:
+                    raise
+
+                time.sleep(settings.DOWNLOAD_BACKOFF * 2 ** attempt)
+            except Exception:
+                if partial_path.exists():
+                    partial_path.unlink()
+                raise
 
     def open_picture(self):
         """
@@ -49,57 +138,93 @@ class Miniature:
         self.picture = Image.open(self.picture_path)
         return self.picture
 
+    def picture_at_least(self, min_size):
+        """
+        Open the cheapest version of the picture whose shortest side has at
+        least min_size pixels (a thumbnail, or the original decoded at a
+        reduced scale), returning an Image instance. Its positions are the
+        ones of the original picture, scaled by the ratio of their widths
+        horizontally, and of their heights vertically (the sides are rounded
+        separately, so the ratios can differ slightly).
+        """
+        return thumbnails.open_at_least(self.picture_path, self.file_name,
+                                        min_size)
+
     def load_objects(self):
         """
-        Load tagged objects from the json file.
+        Load tagged objects from the objects store.
         """
-        if self.objects_path.exists():
-            with self.objects_path.open() as objects_file:
-                self.objects = [TaggedObject.deserialize(raw_object_data)
-                                for raw_object_data in json.load(objects_file)]
-        else:
-            self.objects = []
+        self.objects = [TaggedObject.deserialize(raw_object_data)
+                        for raw_object_data in objects_store.get().load(
+                            self.miniature_id)]
+
+    def load_proposals(self):
+        """
+        Get the objects proposed by infer_objects.py, as (TaggedObject, score)
+        pairs, best scores first.
+        """
+        raw_proposals = objects_store.get().load_proposals(self.miniature_id)
+        return [(TaggedObject.deserialize(raw_object_data), score)
+                for raw_object_data, score in raw_proposals]
 
     def save_objects(self):
         """
-        Save tagged objects into the json file.
+        Save tagged objects into the json file, and update the objects store.
         """
-        with self.objects_path.open('w') as objects_file:
-            raw_data = [tagged_object.serialize()
-                        for tagged_object in self.objects]
-            json.dump(raw_data, objects_file)
+        save_raw_objects(self.miniature_id,
+                         [tagged_object.serialize()
+                          for tagged_object in self.objects])
 
     def __str__(self):
         return '<Miniature {} ({})>'.format(self.miniature_id, self.file_name)
 
+    @classmethod
+    def from_metadata(cls, miniature_data):
+        """
+        Build a Miniature from a tuple of its metadata (as read from the
+        metadata index).
+        """
+        (manuscript_id, miniature_id, file_name,
+         start_year, end_year, tags) = miniature_data
+        return Miniature(
+            manuscript_id=manuscript_id,
+            miniature_id=miniature_id,
+            file_name=file_name,
+            start_year=start_year,
+            end_year=end_year,
+            tags=tags,
+        )
+
     @classmethod
     def all(cls):
         """
         Read all the miniatures metadata, and return them as Miniature
-        instances (ignoring bad lines in the csv).
-        """
-        for line in settings.METADATA_CSV_PATH.open().readlines():
-            fields = [field.strip()
-                      for field in line.split(',')
-                      if field.strip()]
-
-            if len(fields) > 4:
-                tags = fields[5:] if len(fields) > 5 else []
-                tags = [tag.lower() for tag in tags]
-                yield Miniature(
-                    manuscript_id=int(fields[0]),
-                    miniature_id=int(fields[1]),
-                    file_name=fields[2],
-                    start_year=eval(fields[3]),
-                    end_year=eval(fields[4]),
-                    tags=tags,
-                )
-
-
-@attr.s
+        instances (ignoring bad lines in the csv). The metadata is read from
+        its binary index, which is rebuilt only when the csv changes.
+        """
+        for miniature_data in metadata_index.load():
+            yield cls.from_metadata(miniature_data)
+
+    @classmethod
+    def query(cls, tags=None, any_tags=None, years=None, miniature_ids=None):
+        """
+        Return the miniatures having all the tags, at least one of any_tags,
+        years overlapping a (from, to) range (either end can be None) and one
+        of the miniature ids, in the order of the csv. Every criteria is
+        optional, and they are answered from indexes, without scanning all
+        the miniatures.
+        """
+        index = metadata_index.load()
+        positions = metadata_index.query_index(index).positions(
+            tags, any_tags, years, miniature_ids)
+        for position in positions.tolist():
+            yield cls.from_metadata(index.row(position))
+
+
+@attr.s(slots=True, frozen=True)
 class TaggedObject:
     name = attr.ib()
-    position = attr.ib()
+    position = attr.ib(converter=tuple)
 
     def serialize(self):
         """
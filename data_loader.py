@@ -0,0 +1,237 @@
+"""
+Stream training batches of an object-or-not set, instead of loading the whole
+set (and a float copy of it) in memory. Samples are read either from the
+picture files of the set, or from its tensor file (see
+generate_dataframe.py --format=tensor), only when their batch is needed.
+Shuffling only permutes the sample indexes, so it doesn't need the samples in
+memory either. Batches can also be augmented (see augmentation.py), as they
+are built.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import math
+
+from keras.utils import Sequence
+import numpy as np
+
+from generate_dataframe import set_pictures, tensor_path
+from utils import get_picture_pixels, load_tensor
+
+
+class SetPicturesSamples:
+    """
+    Samples of a set read from its picture files, decoded and resized when
+    requested.
+    """
+    def __init__(self, object_name, picture_size):
+        self.picture_size = picture_size
+        pictures = set_pictures(object_name)
+        self.paths = [path for _, path in pictures]
+        self.labels = np.array([label for label, _ in pictures],
+                               dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def pixels(self, indexes):
+        """
+        Pixels of some samples, as a (n, size, size, 3) uint8 array.
+        """
+        pixels = np.empty((len(indexes), self.picture_size,
+                           self.picture_size, 3), dtype=np.uint8)
+        for position, index in enumerate(indexes):
+            pixels[position] = get_picture_pixels(self.paths[index],
+                                                  self.picture_size)
+        return pixels
+
+
+class ArraySamples:
+    """
+    Samples already in memory, as a (n, size, size, 3) uint8 array of pixels
+    and their labels.
+    """
+    def __init__(self, pixels, labels):
+        self.pixels_array = np.asarray(pixels, dtype=np.uint8)
+        self.labels = np.asarray(labels, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def pixels(self, indexes):
+        return self.pixels_array[indexes]
+
+
+class TensorSamples:
+    """
+    Samples of a set read from its memory mapped tensor file (only the
+    requested ones are read from disk).
+    """
+    def __init__(self, object_name, picture_size):
+        self.path = tensor_path(object_name, picture_size)
+        self.tensor, sidecar = load_tensor(self.path)
+        self.labels = sidecar.label.values.astype(np.uint8)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        # worker processes map the file again, instead of receiving a copy of
+        # the whole tensor
+        state = dict(self.__dict__)
+        state['tensor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tensor = np.load(str(self.path), mmap_mode='r')
+
+    def pixels(self, indexes):
+        return np.asarray(self.tensor[indexes])
+
+
+SAMPLES_SOURCES = {
+    'pictures': SetPicturesSamples,
+    'tensor': TensorSamples,
+}
+
+
+def load_batch(samples, indexes, augmentation=None, random_generator=None):
+    """
+    Build the (inputs, labels) of a batch of samples, with the inputs as
+    float32 values between 0 and 1, randomly transformed if an augmentation
+    is specified.
+    """
+    # reading in order is friendlier to the disk (and the batch is shuffled
+    # anyway)
+    indexes = np.sort(indexes)
+    inputs = samples.pixels(indexes).astype(np.float32)
+    inputs /= 255
+    if augmentation is not None:
+        inputs = augmentation.apply(inputs, random_generator)
+    return inputs, samples.labels[indexes]
+
+
+class BatchLoader(Sequence):
+    """
+    Keras Sequence of the batches of a set (or a subset of it, given the
+    indexes of its samples), reshuffled after each epoch, and augmented if
+    an augmentation is specified. With a seed, the order of each epoch and
+    the transforms of each batch are reproducible.
+
+    It can be given to model.fit_generator (whose workers and max_queue_size
+    then apply), or iterated with prefetch_batches.
+    """
+    def __init__(self, samples, batch_size=128, indexes=None, shuffle=True,
+                 seed=None, augmentation=None):
+        if indexes is None:
+            indexes = np.arange(len(samples))
+
+        self.samples = samples
+        self.batch_size = batch_size
+        self.indexes = np.asarray(indexes)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.augmentation = augmentation
+        self.epoch = 0
+        self.order = self.epoch_order()
+
+    def epoch_order(self):
+        """
+        The order in which the samples are used in the current epoch.
+        """
+        if not self.shuffle:
+            return self.indexes
+
+        if self.seed is None:
+            random_generator = np.random.default_rng()
+        else:
+            random_generator = np.random.default_rng([self.seed, self.epoch])
+        return random_generator.permutation(self.indexes)
+
+    def batch_indexes(self, batch_number):
+        start = batch_number * self.batch_size
+        return self.order[start:start + self.batch_size]
+
+    def batch_random_generator(self, batch_number):
+        """
+        The random generator for the transforms of a batch (None without
+        augmentation).
+        """
+        if self.augmentation is None:
+            return None
+        if self.seed is None:
+            return np.random.default_rng()
+        return np.random.default_rng([self.seed, self.epoch, batch_number])
+
+    def __len__(self):
+        return math.ceil(len(self.indexes) / self.batch_size)
+
+    def __getitem__(self, batch_number):
+        return load_batch(self.samples, self.batch_indexes(batch_number),
+                          self.augmentation,
+                          self.batch_random_generator(batch_number))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = self.epoch_order()
+
+
+def iter_batches_indexes(loader, epochs=None):
+    """
+    Yield the sample indexes of each batch of a loader, and the random
+    generator for its transforms, epoch after epoch (forever, unless the
+    amount of epochs is specified).
+    """
+    epoch = 0
+    while epochs is None or epoch < epochs:
+        for batch_number in range(len(loader)):
+            yield (loader.batch_indexes(batch_number),
+                   loader.batch_random_generator(batch_number))
+        loader.on_epoch_end()
+        epoch += 1
+
+
+# samples and augmentation of the loader being prefetched, sent once to each
+# worker process
+worker_samples = None
+worker_augmentation = None
+
+
+def set_worker_samples(samples, augmentation=None):
+    global worker_samples, worker_augmentation
+    worker_samples = samples
+    worker_augmentation = augmentation
+
+
+def load_worker_batch(indexes, random_generator=None):
+    return load_batch(worker_samples, indexes, worker_augmentation,
+                      random_generator)
+
+
+def prefetch_batches(loader, workers=None, max_queue_size=10, epochs=None):
+    """
+    Yield the batches of a loader, epoch after epoch (forever, unless the
+    amount of epochs is specified), built in advance by a pool of processes (0
+    means one per cpu). At most max_queue_size batches are pending at once.
+    Without workers, batches are built in this process when needed.
+    """
+    all_indexes = iter_batches_indexes(loader, epochs)
+    if workers is None:
+        for indexes, random_generator in all_indexes:
+            yield load_batch(loader.samples, indexes, loader.augmentation,
+                             random_generator)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers or None,
+                             initializer=set_worker_samples,
+                             initargs=(loader.samples,
+                                       loader.augmentation)) as executor:
+        pending = deque()
+        for indexes, random_generator in all_indexes:
+            if len(pending) >= max_queue_size:
+                yield pending.popleft().result()
+            pending.append(executor.submit(load_worker_batch, indexes,
+                                           random_generator))
+
+        while pending:
+            yield pending.popleft().result()
@@ -1,22 +1,355 @@
-import sys
+"""
+Download miniatures from the metadata file, that aren't already downloaded in
+the miniatures directory (it's able to resume after an incomplete run). A
+manifest remembers the size, sha1 and cache validators (etag and last
+modified date) of each downloaded picture.
+
+Usage:
+    download_pictures.py [options]
+
+Options:
+    --workers=WORKERS       how many pictures to download in parallel
+                            (defaults to settings.DOWNLOAD_WORKERS).
+    --refresh               also request the pictures already downloaded,
+                            with conditional requests, so only the ones that
+                            changed in the server are downloaded again.
+    --verify                first check the downloaded pictures (in parallel,
+                            without fully decoding them), and download again
+                            the broken or changed ones.
+    --verify-workers=N      verify pictures in that many processes (defaults
+                            to one per cpu).
+    --shard=I/N             only download the miniatures of a shard (see
+                            shards.py), with its own manifest.
+    --profile               record per-stage timings, counters and memory
+                            usage, and save them as a json report.
+    --profile-report=PATH   where to save the profile report
+                            [default: profile_report.json].
+    --cprofile=PATH         also dump cProfile stats of the main process.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+
+import attr
+from docopt import docopt
+from PIL import Image
+import requests
 
 from core import Miniature
+import instrumentation
+import settings
+from shards import in_shard, parse_shard, shard_path, shard_paths
+
+
+@attr.s
+class DownloadStats:
+    downloaded = attr.ib(default=0)
+    already_present = attr.ib(default=0)
+    not_modified = attr.ib(default=0)
+    broken = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    bytes_written = attr.ib(default=0)
+    started_at = attr.ib(default=attr.Factory(time.monotonic))
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def count(self, outcome, size=0):
+        """
+        Register the outcome of one miniature.
+        """
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.bytes_written += size
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def __str__(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return ('{} downloaded, {} already present, {} not modified, '
+                '{} broken, {} failed, '
+                '{:.1f} MB in {:.1f}s ({:.2f} MB/s, {:.1f} pictures/s)').format(
+                    self.downloaded, self.already_present, self.not_modified,
+                    self.broken, self.failed,
+                    self.bytes_written / 1e6, elapsed,
+                    self.bytes_written / 1e6 / elapsed,
+                    self.downloaded / elapsed)
+
+
+class DownloadManifest:
+    """
+    Size, sha1 and cache validators of the downloaded pictures (by file name),
+    saved as json. Entries can be recorded from several threads.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.entries = {}
+        if manifest_path.exists():
+            with manifest_path.open() as manifest_file:
+                self.entries = json.load(manifest_file)
+
+    def get(self, file_name):
+        with self.lock:
+            return self.entries.get(file_name)
+
+    def record(self, file_name, entry):
+        """
+        Remember a downloaded picture, saving the manifest every
+        settings.DOWNLOAD_MANIFEST_SAVE_INTERVAL changes.
+        """
+        with self.lock:
+            self.entries[file_name] = entry
+            self.changes += 1
+            if self.changes % settings.DOWNLOAD_MANIFEST_SAVE_INTERVAL == 0:
+                self._save()
+
+    def forget(self, file_name):
+        with self.lock:
+            self.entries.pop(file_name, None)
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        """
+        Save the manifest atomically (must hold the lock).
+        """
+        partial_path = self.manifest_path.with_name(
+            self.manifest_path.name + '.part')
+        with partial_path.open('w') as manifest_file:
+            json.dump(self.entries, manifest_file)
+        partial_path.replace(self.manifest_path)
+
 
+JPEG_END_MARKER = b'\xff\xd9'
 
-def download_pending_pictures():
+
+def file_sha1(path):
+    """
+    Sha1 of a file, reading it in chunks.
+    """
+    content_hash = hashlib.sha1()
+    with open(str(path), 'rb') as content_file:
+        for chunk in iter(lambda: content_file.read(
+                settings.DOWNLOAD_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def verify_picture(picture_path, expected_size=None, expected_sha1=None):
+    """
+    Check a downloaded picture without decoding its pixels: its size and sha1
+    (if they are known), its structure (using PIL's verify), and for jpegs,
+    that it isn't truncated (it must end with the end of image marker).
+    Returns the problem found, or None.
+    """
+    try:
+        size = os.path.getsize(str(picture_path))
+        if expected_size is not None and size != expected_size:
+            return 'size changed ({} bytes, expected {})'.format(
+                size, expected_size)
+        if expected_sha1 is not None and (file_sha1(picture_path) !=
+                                          expected_sha1):
+            return 'content changed (sha1 mismatch)'
+
+        with Image.open(str(picture_path)) as picture:
+            picture_format = picture.format
+            picture.verify()
+
+        if picture_format == 'JPEG':
+            with open(str(picture_path), 'rb') as picture_file:
+                picture_file.seek(max(size - 1024, 0))
+                # some encoders pad the file after the marker
+                tail = picture_file.read().rstrip(b'\0')
+            if not tail.endswith(JPEG_END_MARKER):
+                return 'truncated'
+    except Exception as err:
+        return 'invalid ({})'.format(err)
+
+    return None
+
+
+def unique_pictures(miniatures):
+    """
+    Keep one miniature per picture file (some miniatures share the file name
+    of their picture, and downloading it twice at once would make both
+    downloads write the same temporary file).
+    """
+    seen = set()
+    unique = []
+    for miniature in miniatures:
+        if miniature.file_name not in seen:
+            seen.add(miniature.file_name)
+            unique.append(miniature)
+    return unique
+
+
+def verify_pictures(miniatures, manifest, stats, workers=None):
+    """
+    Verify the downloaded pictures in a pool of processes, removing the broken
+    or changed ones (and their manifest entries), so they are downloaded
+    again.
+    """
+    # pictures shared by several miniatures are verified once
+    present = [miniature for miniature in unique_pictures(miniatures)
+               if miniature.picture_path.exists()]
+    expected_sizes = []
+    expected_sha1s = []
+    for miniature in present:
+        entry = manifest.get(miniature.file_name) or {}
+        expected_sizes.append(entry.get('size'))
+        expected_sha1s.append(entry.get('sha1'))
+
+    print('Verifying', len(present), 'pictures...', flush=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        problems = executor.map(verify_picture,
+                                [m.picture_path for m in present],
+                                expected_sizes, expected_sha1s, chunksize=32)
+        for miniature, problem in zip(present, problems):
+            if problem is not None:
+                stats.count('broken')
+                print(miniature, 'is broken:', problem, flush=True)
+                miniature.picture_path.unlink(missing_ok=True)
+                manifest.forget(miniature.file_name)
+
+
+def build_session(workers):
+    """
+    Build a requests session whose connection pool can serve all the workers.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_miniature(miniature_number, miniature, session, stats, manifest,
+                       refresh=False):
+    """
+    Download a single miniature, unless it's already present. When refreshing,
+    present ones are requested too, conditionally on the validators of the
+    manifest.
+    """
+    present = miniature.picture_path.exists()
+    if present and not refresh:
+        stats.count('already_present')
+        return
+
+    validators = {}
+    entry = manifest.get(miniature.file_name)
+    if present and entry is not None:
+        validators = dict(etag=entry['etag'],
+                          last_modified=entry['last_modified'])
+
+    try:
+        entry = miniature.download_picture(session=session, **validators)
+    except Exception as err:
+        stats.count('failed')
+        print(miniature_number, miniature, 'failed:', err, flush=True)
+    else:
+        if entry is None:
+            stats.count('not_modified')
+        else:
+            manifest.record(miniature.file_name, entry)
+            stats.count('downloaded', entry['size'])
+            print(miniature_number, miniature, 'done', flush=True)
+
+
+def open_manifest(miniatures, shard=None):
+    """
+    Open the download manifest (or the one of a shard, which starts with the
+    entries of its miniatures in the merged manifest).
+    """
+    manifest_path = shard_path(settings.DOWNLOAD_MANIFEST_PATH, shard)
+    manifest = DownloadManifest(manifest_path)
+    if shard is not None and not manifest_path.exists():
+        merged = DownloadManifest(settings.DOWNLOAD_MANIFEST_PATH)
+        file_names = {miniature.file_name for miniature in miniatures}
+        manifest.entries = {file_name: entry
+                            for file_name, entry in merged.entries.items()
+                            if file_name in file_names}
+    return manifest
+
+
+def merge_manifests(shards_count):
+    """
+    Merge the download manifests of all the shards into the regular one.
+    """
+    manifest = DownloadManifest(settings.DOWNLOAD_MANIFEST_PATH)
+    manifest.entries = {}
+    for path in shard_paths(settings.DOWNLOAD_MANIFEST_PATH, shards_count):
+        manifest.entries.update(DownloadManifest(path).entries)
+    manifest.save()
+    print('Merged the download manifests of', shards_count, 'shards,',
+          len(manifest.entries), 'pictures')
+
+
+def download_pending_pictures(workers=None, refresh=False, verify=False,
+                              verify_workers=None, shard=None):
     """
     Download miniatures from the metadata file, that aren't already downloaded
     in the miniatures directory (it's able to resume after an incomplete run).
+    Downloads run in a bounded pool of threads sharing a pooled session.
+
+    Refreshing requests the present pictures too, downloading only the ones
+    that changed. Verifying checks the present pictures first, so the broken
+    or changed ones are downloaded again. With a shard, only its miniatures
+    are downloaded.
     """
-    for miniature_number, miniature in enumerate(Miniature.all()):
-        print(miniature_number, miniature, '...', end=' ', flush=True)
-        if miniature.picture_path.exists():
-            print('already present')
-        else:
-            print('downloading...', end=' ', flush=True)
-            miniature.download_picture()
-            print('done')
+    if workers is None:
+        workers = settings.DOWNLOAD_WORKERS
+
+    with instrumentation.stage('read_metadata'):
+        miniatures = [miniature for miniature in Miniature.all()
+                      if in_shard(miniature.miniature_id, shard)]
+    instrumentation.count('read_metadata', items=len(miniatures))
+
+    stats = DownloadStats()
+    manifest = open_manifest(miniatures, shard)
+
+    if verify:
+        with instrumentation.stage('verify'):
+            verify_pictures(miniatures, manifest, stats, verify_workers)
+        manifest.save()
+
+    with instrumentation.stage('download'):
+        with build_session(workers) as session:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for miniature_number, miniature in enumerate(
+                        unique_pictures(miniatures)):
+                    executor.submit(download_miniature, miniature_number,
+                                    miniature, session, stats, manifest,
+                                    refresh)
+    instrumentation.count('download', items=stats.downloaded,
+                          bytes_written=stats.bytes_written)
+
+    manifest.save()
+    print(stats)
+    return stats
+
+
+def run(opts):
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
+
+    verify_workers = opts['--verify-workers']
+    if verify_workers is not None:
+        verify_workers = int(verify_workers)
+
+    with instrumentation.profiling(opts, 'download_pictures'):
+        download_pending_pictures(workers, opts['--refresh'],
+                                  opts['--verify'], verify_workers,
+                                  parse_shard(opts['--shard']))
 
 
 if __name__ == '__main__':
-    download_pending_pictures()
+    run(docopt(__doc__))
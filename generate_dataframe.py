@@ -1,59 +1,328 @@
 """
-Generate a pandas dataframe from a pictures set.
+Generate pandas dataframes (or memory mappable tensors) from a pictures set,
+at one or more picture sizes. Each picture is decoded only once for all the
+sizes, and pictures already present in previous outputs aren't processed
+again (new pictures are appended, and removed ones dropped).
 
 Usage:
-    generate_dataframe.py OBJECT_NAME PICTURE_SIZE
+    generate_dataframe.py OBJECT_NAME PICTURE_SIZE... [options]
 
 Options:
-    OBJECT_NAME         the name of the object.
-    PICTURE_SIZE        the size of the pictures inside the dataframe.
+    OBJECT_NAME             the name of the object.
+    PICTURE_SIZE            the size of the pictures inside the dataframe.
+    --workers=WORKERS       decode pictures in that many processes (0 means
+                            one per cpu).
+    --format=FORMAT         "dataframe" to pickle a pandas dataframe, or
+                            "tensor" to write a (N, size, size, 3) uint8 .npy
+                            file plus a csv with the file, miniature_id and
+                            label of each sample [default: dataframe].
+    --shard=I/N             only process the pictures of the miniatures of a
+                            shard (see shards.py), into outputs of its own.
+    --profile               record per-stage timings, counters and memory
+                            usage, and save them as a json report.
+    --profile-report=PATH   where to save the profile report
+                            [default: profile_report.json].
+    --cprofile=PATH         also dump cProfile stats of the main process.
 """
+import os
+
 from docopt import docopt
 import numpy as np
 import pandas as pd
 
-from utils import get_dataframe_from_dir
+import instrumentation
+from utils import (TensorWriter, input_columns_names,
+                   iter_pictures_pixels_sizes, load_tensor)
 from settings import OBJECTS_PICTURES_SETS_DIR
+from shards import in_shard, parse_shard, shard_path, shard_paths
 
 
-def get_subset_dataframe(object_name, picture_size, subset_name, label):
+def get_id_from_file(file_name):
     """
-    Get the dataframe containing all the pictures from a subset of an
-    object-or-not set (subsets are either positive or negative examples).
+    Get the miniature id from the name of a picture in a set.
     """
-    subset_path = OBJECTS_PICTURES_SETS_DIR / object_name / subset_name
+    return file_name.split('_')[0]
+
 
-    get_id_from_file = lambda x: x.split('_')[0]
+def dataframe_path(object_name, picture_size):
+    """
+    Path of the pickled dataframe of an object-or-not set.
+    """
+    file_name = 'dataframe_{}.pkl'.format(picture_size)
+    return OBJECTS_PICTURES_SETS_DIR / object_name / file_name
 
-    pictures_df = get_dataframe_from_dir(subset_path, picture_size)
-    pictures_df['miniature_id'] = pictures_df.file.map(get_id_from_file)
-    pictures_df.loc[:, 'label'] = label
 
-    return pictures_df
+def tensor_path(object_name, picture_size):
+    """
+    Path of the tensor file of an object-or-not set.
+    """
+    file_name = 'tensor_{}.npy'.format(picture_size)
+    return OBJECTS_PICTURES_SETS_DIR / object_name / file_name
 
 
-def generate(object_name, picture_size):
+def set_pictures(object_name):
     """
-    Generate a dataframe containing all the pictures from an object-or-not set.
+    Get the (label, path) of all the pictures from an object-or-not set
+    (positive examples first).
     """
-    print('Extracting positive examples pictures...')
-    positives = get_subset_dataframe(object_name, picture_size, 'positives', 1)
-    print('Extracting negative examples pictures...')
-    negatives = get_subset_dataframe(object_name, picture_size, 'negatives', 0)
+    set_path = OBJECTS_PICTURES_SETS_DIR / object_name
 
-    print('Joining both subsets...')
-    whole_set = pd.concat([positives, negatives])
+    pictures = []
+    for subset_name, label in (('positives', 1), ('negatives', 0)):
+        subset_paths = sorted((set_path / subset_name).glob('*.jpg'))
+        pictures.extend((label, path) for path in subset_paths)
 
-    print('Dumping the final dataframe...')
-    file_name = 'dataframe_{}.pkl'.format(picture_size)
-    dataframe_path = OBJECTS_PICTURES_SETS_DIR / object_name / file_name
-    whole_set.to_pickle(str(dataframe_path))
+    return pictures
 
-    return whole_set
 
-if __name__ == '__main__':
-    opts = docopt(__doc__)
+class DataframeOutput:
+    """
+    Pickled dataframe of a set at one picture size, with the pixels in the
+    columns of input_columns_names, and the file, miniature_id and label of
+    each picture.
+    """
+    def __init__(self, object_name, picture_size, shard=None):
+        self.picture_size = picture_size
+        self.path = shard_path(dataframe_path(object_name, picture_size),
+                               shard)
+        self.previous = None
+        if self.path.exists():
+            self.previous = pd.read_pickle(str(self.path))
+
+    def keys(self):
+        """
+        The (label, file) of the pictures already in the output.
+        """
+        if self.previous is None:
+            return set()
+        return set(zip(self.previous.label, self.previous.file))
+
+    def start(self, kept_keys, new_rows):
+        """
+        Start writing an output with the kept pictures of the previous one,
+        plus new ones (whose pixels will arrive through add).
+        """
+        if self.previous is None:
+            self.kept = None
+        else:
+            previous_keys = zip(self.previous.label, self.previous.file)
+            kept_mask = [key in kept_keys for key in previous_keys]
+            self.kept = self.previous[kept_mask]
+        self.previous = None
+
+        self.new_rows = new_rows
+        self.new_data = np.empty((len(new_rows), 3 * self.picture_size ** 2),
+                                 dtype=np.uint8)
+
+    def add(self, position, pixels):
+        # channel-planar, in the order of input_columns_names
+        self.new_data[position] = pixels.transpose(2, 0, 1).reshape(-1)
+
+    def finish(self):
+        with instrumentation.stage('build_dataframe'):
+            new_df = pd.DataFrame(self.new_data,
+                                  columns=input_columns_names(
+                                      self.picture_size))
+            for column in ('file', 'miniature_id', 'label'):
+                new_df[column] = self.new_rows[column].values
+
+            whole_set = pd.concat([self.kept, new_df], ignore_index=True)
+
+        with instrumentation.stage('dump'):
+            whole_set.to_pickle(str(self.path))
+        instrumentation.count('dump', items=len(whole_set),
+                              bytes_written=os.path.getsize(str(self.path)))
+
+        return len(whole_set)
+
+    @classmethod
+    def merge(cls, object_name, picture_size, shards_count):
+        """
+        Concatenate the dataframes of all the shards into the regular one.
+        """
+        path = dataframe_path(object_name, picture_size)
+        whole_set = pd.concat([pd.read_pickle(str(shard_dataframe_path))
+                               for shard_dataframe_path
+                               in shard_paths(path, shards_count)],
+                              ignore_index=True)
+        whole_set.to_pickle(str(path))
+        return len(whole_set)
+
+
+class TensorOutput:
+    """
+    Tensor file of a set at one picture size (see utils.TensorWriter), with
+    its sidecar csv.
+    """
+    def __init__(self, object_name, picture_size, shard=None):
+        self.picture_size = picture_size
+        self.path = shard_path(tensor_path(object_name, picture_size), shard)
+        self.previous_pixels = self.previous_sidecar = None
+        if self.path.exists():
+            self.previous_pixels, self.previous_sidecar = load_tensor(
+                self.path)
+
+    def keys(self):
+        """
+        The (label, file) of the pictures already in the output.
+        """
+        if self.previous_sidecar is None:
+            return set()
+        return set(zip(self.previous_sidecar.label,
+                       self.previous_sidecar.file))
+
+    def start(self, kept_keys, new_rows):
+        """
+        Start writing an output with the kept pictures of the previous one
+        (copied in chunks), plus new ones (whose pixels will arrive through
+        add, in order).
+        """
+        # read back from the sidecar csv, ids are numbers
+        new_rows = new_rows.assign(
+            miniature_id=new_rows.miniature_id.astype(int))
+
+        kept_indexes = []
+        if self.previous_sidecar is not None:
+            previous_keys = zip(self.previous_sidecar.label,
+                                self.previous_sidecar.file)
+            kept_indexes = [index
+                            for index, key in enumerate(previous_keys)
+                            if key in kept_keys]
+
+        self.writer = TensorWriter(self.path,
+                                   len(kept_indexes) + len(new_rows),
+                                   self.picture_size)
+
+        if kept_indexes:
+            for start in range(0, len(kept_indexes), 1024):
+                chunk = kept_indexes[start:start + 1024]
+                self.writer.extend(self.previous_pixels[chunk])
+            self.sidecar = pd.concat(
+                [self.previous_sidecar.iloc[kept_indexes], new_rows],
+                ignore_index=True)
+        else:
+            self.sidecar = new_rows
+
+        self.previous_pixels = self.previous_sidecar = None
+
+    def add(self, position, pixels):
+        self.writer.extend(pixels[np.newaxis])
+
+    def finish(self):
+        self.writer.close(self.sidecar)
+        return len(self.sidecar)
+
+    @classmethod
+    def merge(cls, object_name, picture_size, shards_count):
+        """
+        Concatenate the tensor files (and sidecars) of all the shards into
+        the regular one, copying them in chunks.
+        """
+        path = tensor_path(object_name, picture_size)
+        shards = [load_tensor(shard_tensor_path)
+                  for shard_tensor_path in shard_paths(path, shards_count)]
+
+        writer = TensorWriter(path,
+                              sum(len(sidecar) for _, sidecar in shards),
+                              picture_size)
+        for pixels, _ in shards:
+            for start in range(0, len(pixels), 1024):
+                writer.extend(pixels[start:start + 1024])
+        sidecar = pd.concat([sidecar for _, sidecar in shards],
+                            ignore_index=True)
+        writer.close(sidecar)
+        return len(sidecar)
+
+
+OUTPUT_FORMATS = {
+    'dataframe': DataframeOutput,
+    'tensor': TensorOutput,
+}
+
+
+def generate(object_name, picture_sizes, workers=None,
+             output_format='dataframe', shard=None):
+    """
+    Generate the outputs (dataframes or tensor files) containing all the
+    pictures from an object-or-not set, at each one of the picture sizes.
+    Pictures missing in any of the previous outputs are decoded once and
+    resized to all the sizes, the rest are reused from the previous outputs.
+    With a shard, only the pictures of its miniatures are included, in
+    outputs of its own (see merge_outputs).
+    """
+    if isinstance(picture_sizes, int):
+        picture_sizes = [picture_sizes]
+
+    pictures = [(label, path) for label, path in set_pictures(object_name)
+                if in_shard(get_id_from_file(path.name), shard)]
+    keys = {(label, path.name) for label, path in pictures}
+
+    outputs = [OUTPUT_FORMATS[output_format](object_name, picture_size,
+                                             shard)
+               for picture_size in picture_sizes]
+    kept_keys = keys.intersection(*(output.keys() for output in outputs))
+    new_pictures = [(label, path) for label, path in pictures
+                    if (label, path.name) not in kept_keys]
+
+    print('Set has', len(pictures), 'pictures,', len(new_pictures),
+          'of them need to be processed')
+
+    file_names = [path.name for _, path in new_pictures]
+    # explicit dtypes, otherwise without new pictures the columns would be
+    # floats, and so would the labels of the whole output once concatenated
+    new_rows = pd.DataFrame({
+        'file': pd.Series(file_names, dtype=str),
+        'miniature_id': pd.Series([get_id_from_file(f) for f in file_names],
+                                  dtype=str),
+        'label': pd.Series([label for label, _ in new_pictures],
+                           dtype=np.int64),
+    })
+
+    for output in outputs:
+        output.start(kept_keys, new_rows)
+
+    print('Extracting pictures at sizes', ', '.join(map(str, picture_sizes)),
+          '...')
+    all_pixels = iter_pictures_pixels_sizes(
+        [path for _, path in new_pictures], picture_sizes, workers)
+    for position, pixels_by_size in enumerate(all_pixels):
+        for output, pixels in zip(outputs, pixels_by_size):
+            output.add(position, pixels)
+
+    print('Saving outputs...')
+    for output in outputs:
+        output.finish()
+
+
+def merge_outputs(object_name, picture_sizes, shards_count,
+                  output_format='dataframe'):
+    """
+    Merge the outputs of all the shards of a set into the regular outputs,
+    at each one of the picture sizes.
+    """
+    if isinstance(picture_sizes, int):
+        picture_sizes = [picture_sizes]
+
+    for picture_size in picture_sizes:
+        samples_count = OUTPUT_FORMATS[output_format].merge(
+            object_name, picture_size, shards_count)
+        print('Merged the', output_format, 'of', shards_count, 'shards of the',
+              object_name, 'set at size', picture_size, 'with', samples_count,
+              'pictures')
+
+
+def run(opts):
     object_name = opts['OBJECT_NAME']
-    picture_size = int(opts['PICTURE_SIZE'])
+    picture_sizes = [int(picture_size)
+                     for picture_size in opts['PICTURE_SIZE']]
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
 
-    generate(object_name, picture_size)
+    with instrumentation.profiling(opts, 'generate_dataframe'):
+        generate(object_name, picture_sizes, workers, opts['--format'],
+                 parse_shard(opts['--shard']))
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
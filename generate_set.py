@@ -1,20 +1,56 @@
 """
 Generate a set of picture files containing and not containing the specified
-object.
+object. Re-runs only regenerate the crops of miniatures whose tagged objects
+changed (see the manifest.json in the set dir).
+
+The sets of several objects can be generated at once, in a single pass over
+the miniatures (each picture is decoded only once for all the sets).
 
 Usage:
-    generate_set.py OBJECT_NAME NEGATIVES_RATIO
+    generate_set.py OBJECT_NAME NEGATIVES_RATIO [options]
+    generate_set.py --all-objects NEGATIVES_RATIO [options]
 
 Options:
-    OBJECT_NAME         the name of the object.
-    NEGATIVES_RATIO     how many negative examples to generate per miniature.
+    OBJECT_NAME             the name of the object (or several, separated by
+                            commas).
+    --all-objects           generate the sets of all the objects tagged in the
+                            miniatures.
+    NEGATIVES_RATIO         how many negative examples to generate per
+                            miniature.
+    --workers=WORKERS       process miniatures in that many processes (0 means
+                            one per cpu).
+    --max-in-flight=N       maximum amount of miniatures pending to be
+                            processed at once (defaults to twice the workers).
+    --seed=SEED             seed for the negative examples, to make them
+                            reproducible (defaults to the seed of the last
+                            run).
+    --shard=I/N             only process the miniatures of a shard (see
+                            shards.py), with its own manifest. All the shards
+                            need the same seed.
+    --profile               record per-stage timings, counters and memory
+                            usage, and save them as a json report.
+    --profile-report=PATH   where to save the profile report
+                            [default: profile_report.json].
+    --cprofile=PATH         also dump cProfile stats of the main process.
 """
-from random import randint
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                as_completed, wait)
+from functools import partial
+import hashlib
+import json
+import os
+import random
 
 from docopt import docopt
+import numpy as np
 
 from core import Miniature
+import instrumentation
+from instrumentation import profiler
+import objects_store
+import settings
 from settings import OBJECTS_PICTURES_SETS_DIR
+from shards import in_shard, parse_shard, shard_path, shard_paths
 
 
 def rectangle_to_square(rectangle, width, height):
@@ -58,6 +94,38 @@ def rectangle_to_square(rectangle, width, height):
     return from_x, from_y, to_x, to_y
 
 
+def rectangles_to_squares(rectangles, widths, heights):
+    """
+    Vectorized rectangle_to_square: converts a (n, 4) array of rectangles to
+    squares inside pictures of the given widths and heights (numbers, or (n,)
+    arrays with the size of the picture of each rectangle).
+    """
+    rectangles = np.asarray(rectangles, dtype=np.int64).reshape(-1, 4)
+    from_x, from_y, to_x, to_y = rectangles.T
+
+    rectangles_width = to_x - from_x
+    rectangles_height = to_y - from_y
+    sizes = np.maximum(rectangles_width, rectangles_height)
+
+    x_centers = from_x + rectangles_width // 2
+    y_centers = from_y + rectangles_height // 2
+
+    squares = np.stack([x_centers - sizes // 2, y_centers - sizes // 2,
+                        x_centers + sizes // 2, y_centers + sizes // 2],
+                       axis=1)
+
+    # ensure fitting, moving the squares right/down when they start before
+    # the picture, or else left/up when they end after it
+    for from_column, to_column, limits in ((0, 2, widths), (1, 3, heights)):
+        starts = squares[:, from_column]
+        ends = squares[:, to_column]
+        shifts = np.where(starts < 0, -starts, np.minimum(limits - ends, 0))
+        squares[:, from_column] += shifts
+        squares[:, to_column] += shifts
+
+    return squares
+
+
 def rectangles_overlap(rectangle1, rectangle2):
     """
     True when two rectangles overlap.
@@ -79,101 +147,463 @@ def extract_positive_rectangles(miniatures, object_name):
     for miniature in miniatures:
         width, height = miniature.picture.size
 
-        for tagged_object in miniature.objects:
-            if tagged_object.name == object_name:
-                yield miniature, rectangle_to_square(tagged_object.position,
-                                                     width, height)
+        positions = [tagged_object.position
+                     for tagged_object in miniature.objects
+                     if tagged_object.name == object_name]
+        if positions:
+            squares = rectangles_to_squares(positions, width, height)
+            for square in squares.tolist():
+                yield miniature, tuple(square)
+
+
+def rectangles_overlap_matrix(rectangles1, rectangles2):
+    """
+    Vectorized rectangles_overlap: given (n, 4) and (m, 4) arrays, returns a
+    (n, m) boolean array telling which pairs of rectangles overlap.
+    """
+    rectangles1 = np.asarray(rectangles1).reshape(-1, 1, 4)
+    rectangles2 = np.asarray(rectangles2).reshape(1, -1, 4)
 
+    return ((rectangles1[..., 0] < rectangles2[..., 2]) &
+            (rectangles1[..., 2] > rectangles2[..., 0]) &
+            (rectangles1[..., 1] < rectangles2[..., 3]) &
+            (rectangles1[..., 3] > rectangles2[..., 1]))
 
-def extract_negative_rectangles(miniatures, object_name, negatives_ratio):
+
+def sample_negative_squares(width, height, avoid_positions, count,
+                            random_generator):
+    """
+    Draw up to count random squares inside a picture, not overlapping any of
+    the rectangles to avoid. Candidates are drawn and tested in batches, and
+    the search gives up after settings.NEGATIVES_ATTEMPTS_PER_EXAMPLE
+    candidates per requested square, so fewer squares than requested may be
+    returned (as a (n, 4) array).
     """
-    Generate squares not containing the specified object.
+    shortest_size = min(width, height)
+    min_size = max(int(shortest_size / 10), 1)
+    max_size = max(int(shortest_size / 4), min_size)
+    avoid_positions = np.asarray(avoid_positions).reshape(-1, 4)
+
+    found = []
+    found_count = 0
+    attempts_left = count * settings.NEGATIVES_ATTEMPTS_PER_EXAMPLE
+    while found_count < count and attempts_left > 0:
+        batch_size = min(max(4 * (count - found_count), 64), attempts_left)
+        attempts_left -= batch_size
+
+        sizes = random_generator.integers(min_size, max_size, batch_size,
+                                          endpoint=True)
+        from_x = random_generator.integers(0, width - sizes, endpoint=True)
+        from_y = random_generator.integers(0, height - sizes, endpoint=True)
+        candidates = np.stack([from_x, from_y,
+                               from_x + sizes, from_y + sizes], axis=1)
+
+        has_object = rectangles_overlap_matrix(candidates,
+                                               avoid_positions).any(axis=1)
+        valid = candidates[~has_object][:count - found_count]
+        found.append(valid)
+        found_count += len(valid)
+
+    if not found:
+        return np.empty((0, 4), dtype=np.int64)
+    return np.concatenate(found)
+
+
+def extract_negative_rectangles(miniatures, object_name, negatives_ratio,
+                                seed=None):
+    """
+    Generate squares not containing the specified object. With a seed, the
+    squares of each miniature are reproducible (they only depend on the seed
+    and the miniature id, not on the order in which miniatures are processed).
     """
     for miniature in miniatures:
         avoid_positions = [tagged_object.position
                            for tagged_object in miniature.objects
                            if tagged_object.name == object_name]
 
-        width, height = miniature.picture.size
-        shortest_size = min(width, height)
+        if seed is None:
+            random_generator = np.random.default_rng()
+        else:
+            random_generator = np.random.default_rng(
+                [seed, miniature.miniature_id])
 
-        generated = 0
-        while generated < negatives_ratio:
-            example_size = randint(int(shortest_size / 10),
-                                   int(shortest_size / 4))
-            from_x = randint(0, width - example_size)
-            to_x = from_x + example_size
-            from_y = randint(0, height - example_size)
-            to_y = from_y + example_size
+        width, height = miniature.picture.size
+        squares = sample_negative_squares(width, height, avoid_positions,
+                                          negatives_ratio, random_generator)
 
-            has_object = any(rectangles_overlap(tagged_object.position,
-                                                (from_x, from_y, to_x, to_y))
-                             for tagged_object in miniature.objects
-                             if tagged_object.name == object_name)
+        if len(squares) < negatives_ratio:
+            print('Could only generate', len(squares), 'of', negatives_ratio,
+                  'negatives for', miniature)
 
-            if not has_object:
-                generated += 1
-                yield miniature, (from_x, from_y, to_x, to_y)
+        for square in squares.tolist():
+            yield miniature, tuple(square)
 
 
-def miniatures_with_info_about(object_name):
+def miniatures_with_info_about(object_names):
     """
-    Extract miniatures that have info regarding an specific object.
+    Extract miniatures that have info regarding an specific object (or any
+    of several objects).
     """
-    miniatures = []
-    for miniature in Miniature.all():
-        miniature.load_objects()
-        has_object = any(tagged_object.name == object_name
-                         for tagged_object in miniature.objects)
+    if isinstance(object_names, str):
+        object_names = [object_names]
 
-        if has_object:
-            miniatures.append(miniature)
+    store = objects_store.get()
+    miniature_ids = set()
+    for object_name in object_names:
+        miniature_ids.update(store.miniature_ids_with(object_name))
+
+    miniatures = list(Miniature.query(miniature_ids=miniature_ids))
+    for miniature in miniatures:
+        miniature.load_objects()
 
     return miniatures
 
 
-def save_pictures(object_name, subset_name, rectangles):
+def crop_file_name(miniature, rectangle):
     """
-    Save all the rectangles from a subset as separated picture files.
+    Name of the picture file of a rectangle cropped from a miniature.
     """
-    subset_path = OBJECTS_PICTURES_SETS_DIR / object_name / subset_name
+    return '{}_{}_{}_{}_{}.jpg'.format(miniature.miniature_id, *rectangle)
 
-    for miniature, rectangle in rectangles:
-        file_name = '{}_{}_{}_{}_{}.jpg'.format(miniature.miniature_id,
-                                                *rectangle)
-        rectangle_path = subset_path / file_name
-        picture = miniature.picture.copy()
-        picture = picture.crop(rectangle)
-        picture.save(rectangle_path)
 
+def save_miniature_objects_crops(miniature, objects_seeds, negatives_ratio):
+    """
+    Open the picture of a single miniature, save its positive and negative
+    examples for the sets of several objects (given as (object_name, seed)
+    pairs) cropping them straight from it, and release it. The negatives of
+    each object only avoid the objects with its name. Returns the id of the
+    miniature, and the file names of the saved crops of each subset, for each
+    object.
+    """
+    with instrumentation.stage('decode'):
+        picture = miniature.open_picture()
+        picture.load()
+    if profiler.enabled:
+        instrumentation.count(
+            'decode', items=1,
+            bytes_read=os.path.getsize(str(miniature.picture_path)))
+
+    crops_by_object = {}
+    try:
+        for object_name, seed in objects_seeds:
+            set_path = OBJECTS_PICTURES_SETS_DIR / object_name
+
+            with instrumentation.stage('extract_rectangles'):
+                subsets = (
+                    ('positives',
+                     list(extract_positive_rectangles([miniature],
+                                                      object_name))),
+                    ('negatives',
+                     list(extract_negative_rectangles([miniature],
+                                                      object_name,
+                                                      negatives_ratio,
+                                                      seed))),
+                )
+
+            for subset_name, rectangles in subsets:
+                for _, rectangle in rectangles:
+                    rectangle_path = (set_path / subset_name /
+                                      crop_file_name(miniature, rectangle))
+                    with instrumentation.stage('crop'):
+                        crop = picture.crop(rectangle)
+                    with instrumentation.stage('save'):
+                        crop.save(rectangle_path)
+                    if profiler.enabled:
+                        instrumentation.count(
+                            'save', items=1,
+                            bytes_written=os.path.getsize(
+                                str(rectangle_path)))
+
+            crops_by_object[object_name] = {
+                subset_name: [crop_file_name(miniature, rectangle)
+                              for _, rectangle in rectangles]
+                for subset_name, rectangles in subsets}
+    finally:
+        picture.close()
+        miniature.picture = None
+
+    return miniature.miniature_id, crops_by_object
+
+
+def bounded_map(executor, function, items, max_in_flight):
+    """
+    Like executor.map, but without submitting more than max_in_flight items at
+    once (so the queue of pending items, and their results, stay bounded).
+    Results are yielded as they complete, not in order.
+    """
+    pending = set()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+        pending.add(executor.submit(function, *item))
 
-def generate(object_name, negatives_ratio):
+    for future in as_completed(pending):
+        yield future.result()
+
+
+def objects_hash(miniature, object_name):
     """
-    Generate picture files having the object, and not having the object.
+    Hash of the positions of the objects of a miniature that matter for the
+    set of an object.
     """
-    miniatures = miniatures_with_info_about(object_name)
+    positions = sorted(list(tagged_object.position)
+                       for tagged_object in miniature.objects
+                       if tagged_object.name == object_name)
+    return hashlib.sha1(json.dumps(positions).encode()).hexdigest()
 
-    print('Will use', len(miniatures), 'miniatures')
 
-    print('Opening all pictures...')
-    for m in miniatures:
-        m.open_picture()
+def load_manifest(set_path, shard=None):
+    """
+    Read the manifest of a set, which remembers the seed and negatives ratio
+    of the last run, and the objects hash and crops of each miniature. The
+    manifest of a shard starts as the part of the merged manifest with the
+    miniatures of the shard.
+    """
+    manifest_path = shard_path(set_path / 'manifest.json', shard)
+    if manifest_path.exists():
+        with manifest_path.open() as manifest_file:
+            return json.load(manifest_file)
 
-    print('Extracting positive examples positions...')
-    positives = list(extract_positive_rectangles(miniatures, object_name))
-    print('Saving positive examples pictures...')
-    save_pictures(object_name, 'positives', positives)
+    if shard is not None:
+        manifest = load_manifest(set_path)
+        manifest['miniatures'] = {
+            miniature_key: entry
+            for miniature_key, entry in manifest['miniatures'].items()
+            if in_shard(miniature_key, shard)}
+        return manifest
 
-    print('Extracting negative examples positions...')
-    negatives = list(extract_negative_rectangles(miniatures, object_name,
-                                                 negatives_ratio))
-    print('Saving negative examples pictures...')
-    save_pictures(object_name, 'negatives', negatives)
+    return {'seed': None, 'negatives_ratio': None, 'miniatures': {}}
 
 
-if __name__ == '__main__':
-    opts = docopt(__doc__)
-    object_name = opts['OBJECT_NAME']
+def save_manifest(set_path, manifest, shard=None):
+    """
+    Save the manifest of a set (atomically, so an interrupted run doesn't
+    leave it broken).
+    """
+    manifest_path = shard_path(set_path / 'manifest.json', shard)
+    partial_path = manifest_path.with_name(manifest_path.name + '.part')
+    with partial_path.open('w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    partial_path.replace(manifest_path)
+
+
+def merge_manifests(object_name, shards_count):
+    """
+    Merge the manifests of all the shards of a set into its regular manifest
+    (the crops are already in the set dirs).
+    """
+    set_path = OBJECTS_PICTURES_SETS_DIR / object_name
+    merged = None
+    for path in shard_paths(set_path / 'manifest.json', shards_count):
+        with path.open() as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if merged is None:
+            merged = manifest
+        elif ((manifest['seed'], manifest['negatives_ratio']) !=
+              (merged['seed'], merged['negatives_ratio'])):
+            raise ValueError('The shards of the {} set used different seeds '
+                             'or negatives ratios'.format(object_name))
+        else:
+            merged['miniatures'].update(manifest['miniatures'])
+
+    save_manifest(set_path, merged)
+    print('Merged the manifests of', shards_count, 'shards of the',
+          object_name, 'set,', len(merged['miniatures']), 'miniatures')
+
+
+def remove_crops(set_path, entry):
+    """
+    Remove the crops recorded in a manifest entry of a miniature.
+    """
+    for subset_name in ('positives', 'negatives'):
+        for file_name in entry[subset_name]:
+            crop_path = set_path / subset_name / file_name
+            if crop_path.exists():
+                crop_path.unlink()
+
+
+def entry_is_current(set_path, entry, miniature_objects_hash):
+    """
+    True when the crops of a miniature recorded in the manifest are still
+    valid: its objects didn't change, and all its crops are present.
+    """
+    return (entry is not None and
+            entry['objects_hash'] == miniature_objects_hash and
+            all((set_path / subset_name / file_name).exists()
+                for subset_name in ('positives', 'negatives')
+                for file_name in entry[subset_name]))
+
+
+def open_set(object_name, negatives_ratio, seed=None, shard=None):
+    """
+    Create the dirs of a set, and read its manifest (or the one of a shard).
+    The seed makes the negatives reproducible; without one, the seed of the
+    last run is reused (or a random one is picked and remembered, except for
+    shards, which must all use the same one). When the seed or negatives
+    ratio change, the previous crops are removed, as none of them can be
+    reused.
+    """
+    set_path = OBJECTS_PICTURES_SETS_DIR / object_name
+    for subset_name in ('positives', 'negatives'):
+        (set_path / subset_name).mkdir(parents=True, exist_ok=True)
+
+    manifest = load_manifest(set_path, shard)
+    if seed is None:
+        seed = manifest['seed']
+    if seed is None:
+        if shard is not None:
+            raise ValueError('The first sharded run of the {} set needs a '
+                             'seed'.format(object_name))
+        seed = random.randrange(2 ** 32)
+
+    entries = manifest['miniatures']
+    if (seed, negatives_ratio) != (manifest['seed'],
+                                   manifest['negatives_ratio']):
+        # every negative would be different, nothing can be reused
+        for entry in entries.values():
+            remove_crops(set_path, entry)
+        entries.clear()
+    manifest.update(seed=seed, negatives_ratio=negatives_ratio)
+
+    return set_path, manifest
+
+
+def generate(object_name, negatives_ratio, workers=None, max_in_flight=None,
+             seed=None, shard=None):
+    """
+    Generate picture files having the object, and not having the object.
+    Miniatures are processed one at a time, or by a pool of processes if
+    workers is specified (0 means one per cpu), with at most max_in_flight
+    miniatures pending at any time.
+
+    Runs are incremental: only the miniatures whose objects changed since the
+    last run get their crops generated again, and the crops of miniatures that
+    don't have the object anymore are removed. The seed makes the negatives
+    reproducible; without one, the seed of the last run is reused (or a
+    random one is picked and remembered).
+
+    With a shard, only its miniatures are processed, and they are tracked in
+    a manifest of their own (see merge_manifests).
+    """
+    generate_sets([object_name], negatives_ratio, workers, max_in_flight,
+                  seed, shard)
+
+
+def generate_sets(object_names, negatives_ratio, workers=None,
+                  max_in_flight=None, seed=None, shard=None):
+    """
+    Generate the sets of several objects (see generate) in a single pass over
+    the miniatures: each miniature that needs crops for any of the sets has
+    its picture decoded once, and its crops for all those sets are saved from
+    it.
+    """
+    with instrumentation.stage('select_miniatures'):
+        miniatures = [miniature
+                      for miniature in miniatures_with_info_about(object_names)
+                      if in_shard(miniature.miniature_id, shard)]
+    instrumentation.count('select_miniatures', items=len(miniatures))
+
+    sets = {}
+    hashes = {}
+    pending = {}
+    for object_name in object_names:
+        set_path, manifest = open_set(object_name, negatives_ratio, seed,
+                                      shard)
+        sets[object_name] = set_path, manifest
+        entries = manifest['miniatures']
+
+        object_miniatures = [
+            miniature for miniature in miniatures
+            if any(tagged_object.name == object_name
+                   for tagged_object in miniature.objects)]
+        hashes[object_name] = {
+            str(miniature.miniature_id): objects_hash(miniature, object_name)
+            for miniature in object_miniatures}
+
+        for miniature_key in list(entries):
+            if not entry_is_current(set_path, entries[miniature_key],
+                                    hashes[object_name].get(miniature_key)):
+                remove_crops(set_path, entries.pop(miniature_key))
+
+        changed = [miniature for miniature in object_miniatures
+                   if str(miniature.miniature_id) not in entries]
+        for miniature in changed:
+            pending.setdefault(miniature.miniature_id, []).append(
+                (object_name, manifest['seed']))
+
+        print('The', object_name, 'set will use', len(object_miniatures),
+              'miniatures,', len(changed), 'of them changed since the last '
+              'run')
+
+    print('Saving positive and negative examples pictures of',
+          len(pending), 'miniatures...')
+    jobs = ((miniature, pending[miniature.miniature_id], negatives_ratio)
+            for miniature in miniatures
+            if miniature.miniature_id in pending)
+
+    def save_manifests():
+        for set_path, manifest in sets.values():
+            save_manifest(set_path, manifest, shard)
+
+    def record(results):
+        for done, (miniature_id, crops_by_object) in enumerate(results, 1):
+            miniature_key = str(miniature_id)
+            for object_name, crops in crops_by_object.items():
+                _, manifest = sets[object_name]
+                manifest['miniatures'][miniature_key] = dict(
+                    crops, objects_hash=hashes[object_name][miniature_key])
+            if done % settings.MANIFEST_SAVE_INTERVAL == 0:
+                save_manifests()
+
+    if workers is None:
+        record(save_miniature_objects_crops(*job) for job in jobs)
+    else:
+        workers = workers or os.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+
+        save_crops = partial(instrumentation.call_collecting,
+                             profiler.enabled, save_miniature_objects_crops)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = bounded_map(executor, save_crops, jobs, max_in_flight)
+            record(instrumentation.merge_collected(results))
+
+    save_manifests()
+
+    for object_name, (_, manifest) in sets.items():
+        entries = manifest['miniatures'].values()
+        total_positives = sum(len(entry['positives']) for entry in entries)
+        total_negatives = sum(len(entry['negatives']) for entry in entries)
+        print('The', object_name, 'set has', total_positives, 'positives and',
+              total_negatives, 'negatives')
+
+
+def run(opts):
+    if opts['--all-objects']:
+        object_names = objects_store.get().object_names()
+    else:
+        object_names = opts['OBJECT_NAME'].split(',')
     negatives_ratio = int(opts['NEGATIVES_RATIO'])
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
+    max_in_flight = opts['--max-in-flight']
+    if max_in_flight is not None:
+        max_in_flight = int(max_in_flight)
+    seed = opts['--seed']
+    if seed is not None:
+        seed = int(seed)
+
+    shard = parse_shard(opts['--shard'])
 
-    generate(object_name, negatives_ratio)
+    with instrumentation.profiling(opts, 'generate_set'):
+        generate_sets(object_names, negatives_ratio, workers, max_in_flight,
+                      seed, shard)
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
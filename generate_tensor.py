@@ -0,0 +1,172 @@
+"""
+Generate a tensor of pictures containing and not containing the specified
+object, cropping and resizing them straight from the miniatures into the final
+array (no intermediate picture files are saved). The result is the same tensor
+file that generate_dataframe.py --format=tensor writes.
+
+Usage:
+    generate_tensor.py OBJECT_NAME NEGATIVES_RATIO PICTURE_SIZE [options]
+
+Options:
+    OBJECT_NAME         the name of the object.
+    NEGATIVES_RATIO     how many negative examples to generate per miniature.
+    PICTURE_SIZE        the size of the pictures inside the tensor.
+    --workers=WORKERS   process miniatures in that many processes (0 means one
+                        per cpu).
+    --max-in-flight=N   maximum amount of miniatures pending to be processed at
+                        once (defaults to twice the workers).
+    --seed=SEED         seed for the negative examples, to make them
+                        reproducible.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+
+from docopt import docopt
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from generate_dataframe import tensor_path
+from generate_set import (bounded_map, crop_file_name,
+                          extract_negative_rectangles,
+                          extract_positive_rectangles,
+                          miniatures_with_info_about)
+from utils import TensorWriter
+
+
+def miniature_samples(miniature, object_name, negatives_ratio, picture_size,
+                      seed=None):
+    """
+    Open the picture of a single miniature (at the smallest resolution that
+    keeps the examples detailed enough), and crop and resize its positive and
+    negative examples. Returns the (file, miniature_id, label) rows of the
+    examples, and their pixels as a (n, picture_size, picture_size, 3) array.
+    """
+    # only reads the header, the positions of the examples are computed on
+    # the original size of the picture
+    picture = miniature.open_picture()
+    try:
+        subsets = (
+            (1, extract_positive_rectangles([miniature], object_name)),
+            (0, extract_negative_rectangles([miniature], object_name,
+                                            negatives_ratio, seed)),
+        )
+        rectangles = [(label, rectangle)
+                      for label, subset_rectangles in subsets
+                      for _, rectangle in subset_rectangles]
+    finally:
+        picture.close()
+        miniature.picture = None
+
+    pixels = np.empty((len(rectangles), picture_size, picture_size, 3),
+                      dtype=np.uint8)
+    rows = []
+    if not rectangles:
+        return rows, pixels
+
+    # decode the cheapest version of the picture in which even the smallest
+    # example still has at least picture_size pixels
+    width, height = picture.size
+    smallest_side = max(min(min(to_x - from_x, to_y - from_y)
+                            for _, (from_x, from_y, to_x, to_y) in rectangles),
+                        1)
+    min_size = math.ceil(picture_size * min(width, height) / smallest_side)
+
+    with miniature.picture_at_least(min_size) as source:
+        # the sides of the source can be rounded independently, so each axis
+        # has its own scale
+        x_scale = source.width / width
+        y_scale = source.height / height
+
+        rgb_source = source
+        if source.mode != 'RGB':
+            rgb_source = source.convert('RGB')
+
+        for position, (label, rectangle) in enumerate(rectangles):
+            # crop and resize in a single step
+            from_x, from_y, to_x, to_y = rectangle
+            box = (from_x * x_scale, from_y * y_scale,
+                   min(to_x * x_scale, source.width),
+                   min(to_y * y_scale, source.height))
+            sample = rgb_source.resize((picture_size, picture_size),
+                                       Image.LANCZOS, box=box)
+            pixels[position] = np.asarray(sample)
+            rows.append((crop_file_name(miniature, rectangle),
+                         miniature.miniature_id, label))
+
+    return rows, pixels
+
+
+def generate(object_name, negatives_ratio, picture_size, workers=None,
+             max_in_flight=None, seed=None):
+    """
+    Generate the tensor file of an object-or-not set, straight from the
+    miniatures. Miniatures are processed one at a time, or by a pool of
+    processes if workers is specified (0 means one per cpu). A seed makes the
+    negatives reproducible.
+    """
+    miniatures = miniatures_with_info_about(object_name)
+
+    print('Will use', len(miniatures), 'miniatures')
+
+    positives_count = sum(tagged_object.name == object_name
+                          for miniature in miniatures
+                          for tagged_object in miniature.objects)
+    capacity = positives_count + negatives_ratio * len(miniatures)
+
+    path = tensor_path(object_name, picture_size)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    writer = TensorWriter(path, capacity, picture_size)
+
+    jobs = ((miniature, object_name, negatives_ratio, picture_size, seed)
+            for miniature in miniatures)
+
+    all_rows = []
+
+    def write_samples(results):
+        for rows, pixels in results:
+            writer.extend(pixels)
+            all_rows.extend(rows)
+
+    print('Cropping and resizing examples into the tensor file...')
+    if workers is None:
+        write_samples(miniature_samples(*job) for job in jobs)
+    else:
+        workers = workers or os.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = 2 * workers
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            write_samples(bounded_map(executor, miniature_samples, jobs,
+                                      max_in_flight))
+
+    sidecar = pd.DataFrame(all_rows,
+                           columns=['file', 'miniature_id', 'label'])
+    writer.close(sidecar)
+
+    print('Saved', len(sidecar), 'examples')
+
+    return sidecar
+
+
+def run(opts):
+    object_name = opts['OBJECT_NAME']
+    negatives_ratio = int(opts['NEGATIVES_RATIO'])
+    picture_size = int(opts['PICTURE_SIZE'])
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
+    max_in_flight = opts['--max-in-flight']
+    if max_in_flight is not None:
+        max_in_flight = int(max_in_flight)
+    seed = opts['--seed']
+    if seed is not None:
+        seed = int(seed)
+
+    generate(object_name, negatives_ratio, picture_size, workers,
+             max_in_flight, seed)
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
@@ -0,0 +1,330 @@
+"""
+Scan whole miniatures with a trained object-or-not model, proposing the
+squares where the object appears. Each picture is scanned with square windows
+at several scales (the windows are squares inside the picture, like the
+examples of generate_set.py), all the windows of a scale are taken as strided
+views of a single resized copy of the picture, and they go through the model in
+big batches. Overlapping hits are merged with non-max suppression, and the
+remaining ones are saved in the objects store as proposed objects.
+
+Usage:
+    infer_objects.py OBJECT_NAME MODEL_PATH PICTURE_SIZE [options]
+
+Options:
+    OBJECT_NAME             the name of the object.
+    MODEL_PATH              the keras model file (saved with model.save).
+    PICTURE_SIZE            the size of the pictures the model was trained on.
+    --scales=SCALES         comma separated sizes of the windows, relative to
+                            the shortest side of the pictures
+                            [default: 0.1,0.175,0.25,0.4].
+    --stride=STRIDE         distance between windows, relative to their size
+                            [default: 0.25].
+    --threshold=SCORE       minimum score of a window to be a proposal
+                            [default: 0.5].
+    --max-overlap=IOU       maximum intersection over union between proposals
+                            (the best one of overlapping windows is kept)
+                            [default: 0.3].
+    --batch-size=N          how many windows go through the model at once
+                            [default: 256].
+    --workers=WORKERS       scan pictures in that many processes (0 means one
+                            per cpu), each one with its own copy of the model.
+    --profile               record per-stage timings, counters and memory
+                            usage, and save them as a json report.
+    --profile-report=PATH   where to save the profile report
+                            [default: profile_report.json].
+    --cprofile=PATH         also dump cProfile stats of the main process.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import math
+import os
+
+from docopt import docopt
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+from core import Miniature, TaggedObject
+from generate_set import rectangles_to_squares
+import instrumentation
+from instrumentation import profiler
+import objects_store
+
+
+def load_keras_model(model_path):
+    """
+    Load a keras model (keras is only imported when it's needed, so stub
+    models can be used without it).
+    """
+    from keras.models import load_model
+    return load_model(str(model_path))
+
+
+def window_starts(size, window_size, step):
+    """
+    Offsets of the windows along an axis: every step pixels, plus a last one
+    ending at the edge, so no part of the picture is left unscanned.
+    """
+    starts = np.arange(0, size - window_size + 1, step)
+    if starts[-1] != size - window_size:
+        starts = np.append(starts, size - window_size)
+    return starts
+
+
+def scale_windows(picture, original_size, picture_size, scale, stride):
+    """
+    Resize a picture so windows of the given scale become picture_size
+    squares, and get all the windows as a strided view of the resized pixels.
+    Returns the view (of the windows at every pixel), the (row_starts,
+    column_starts) of the scanned windows in it, and the (rows, columns, 4)
+    positions of the scanned windows in the original picture, as squares
+    inside it (like generate_set.rectangle_to_square makes them).
+    """
+    width, height = original_size
+    window_size = scale * min(width, height)
+    resized_width = max(round(width * picture_size / window_size),
+                        picture_size)
+    resized_height = max(round(height * picture_size / window_size),
+                         picture_size)
+
+    with instrumentation.stage('resize'):
+        resized = picture.resize((resized_width, resized_height),
+                                 Image.LANCZOS)
+        pixels = np.asarray(resized)
+
+    windows = sliding_window_view(pixels, (picture_size, picture_size),
+                                  axis=(0, 1))
+    windows = windows.transpose(0, 1, 3, 4, 2)
+
+    step = max(round(picture_size * stride), 1)
+    row_starts = window_starts(resized_height, picture_size, step)
+    column_starts = window_starts(resized_width, picture_size, step)
+
+    from_x = column_starts * width / resized_width
+    from_y = row_starts * height / resized_height
+    to_x = np.minimum(from_x + picture_size * width / resized_width, width)
+    to_y = np.minimum(from_y + picture_size * height / resized_height, height)
+
+    rows, columns = len(row_starts), len(column_starts)
+    rectangles = np.empty((rows, columns, 4), dtype=np.int64)
+    rectangles[..., 0] = np.round(from_x)[np.newaxis]
+    rectangles[..., 1] = np.round(from_y)[:, np.newaxis]
+    rectangles[..., 2] = np.round(to_x)[np.newaxis]
+    rectangles[..., 3] = np.round(to_y)[:, np.newaxis]
+    positions = rectangles_to_squares(rectangles, width, height).reshape(
+        rows, columns, 4)
+
+    return windows, (row_starts, column_starts), positions
+
+
+def score_windows(model, windows, starts, batch_size):
+    """
+    Run the scanned windows of a strided view (the ones at the given row and
+    column starts) through the model, copying only one batch of windows at a
+    time. Returns their (rows, columns) scores.
+    """
+    row_starts, column_starts = starts
+    rows, columns = len(row_starts), len(column_starts)
+    scores = np.empty(rows * columns, dtype=np.float32)
+    for start in range(0, rows * columns, batch_size):
+        window_rows, window_columns = np.divmod(
+            np.arange(start, min(start + batch_size, rows * columns)),
+            columns)
+        inputs = windows[row_starts[window_rows],
+                         column_starts[window_columns]].astype(np.float32)
+        inputs /= 255
+
+        with instrumentation.stage('predict'):
+            outputs = model.predict(inputs, batch_size=len(inputs))
+        scores[start:start + len(inputs)] = np.ravel(outputs)
+        instrumentation.count('predict', items=len(inputs))
+
+    return scores.reshape(rows, columns)
+
+
+def intersection_over_union(rectangle, rectangles):
+    """
+    Intersection over union of a rectangle with each one of a (n, 4) array of
+    rectangles.
+    """
+    inner_width = np.clip(np.minimum(rectangle[2], rectangles[:, 2]) -
+                          np.maximum(rectangle[0], rectangles[:, 0]), 0, None)
+    inner_height = np.clip(np.minimum(rectangle[3], rectangles[:, 3]) -
+                           np.maximum(rectangle[1], rectangles[:, 1]), 0, None)
+    intersection = inner_width * inner_height
+
+    area = (rectangle[2] - rectangle[0]) * (rectangle[3] - rectangle[1])
+    areas = ((rectangles[:, 2] - rectangles[:, 0]) *
+             (rectangles[:, 3] - rectangles[:, 1]))
+
+    return intersection / np.maximum(area + areas - intersection, 1)
+
+
+def non_max_suppression(positions, scores, max_overlap):
+    """
+    Keep the best scored rectangles, dropping the ones that overlap a better
+    one by more than max_overlap (intersection over union). Returns the
+    indexes of the kept rectangles, best first.
+    """
+    order = np.argsort(-scores, kind='stable')
+    kept = []
+    while len(order):
+        best, order = order[0], order[1:]
+        kept.append(best)
+        overlaps = intersection_over_union(positions[best], positions[order])
+        order = order[overlaps <= max_overlap]
+
+    return np.array(kept, dtype=np.int64)
+
+
+def scan_miniature(miniature, model, object_name, picture_size, scales,
+                   stride=0.25, threshold=0.5, max_overlap=0.3,
+                   batch_size=256):
+    """
+    Scan the picture of a single miniature with windows at all the scales, and
+    propose the best non overlapping ones with a score above the threshold.
+    Returns the miniature id and the proposals, as (TaggedObject, score)
+    pairs.
+    """
+    with instrumentation.stage('decode'):
+        # only reads the header
+        with miniature.open_picture() as original:
+            original_size = original.size
+        miniature.picture = None
+
+        # decode just enough to resize for the smallest windows
+        min_size = math.ceil(picture_size / min(scales))
+        source = miniature.picture_at_least(min_size)
+        source.load()
+        picture = source
+        if picture.mode != 'RGB':
+            picture = picture.convert('RGB')
+
+    all_positions = [np.empty((0, 4), dtype=np.int64)]
+    all_scores = [np.empty(0, dtype=np.float32)]
+    with source:
+        for scale in scales:
+            if scale * min(original_size) < 1:
+                continue
+            windows, starts, positions = scale_windows(
+                picture, original_size, picture_size, scale, stride)
+            scores = score_windows(model, windows, starts, batch_size)
+
+            hits = scores >= threshold
+            all_positions.append(positions[hits])
+            all_scores.append(scores[hits])
+
+    with instrumentation.stage('non_max_suppression'):
+        positions = np.concatenate(all_positions)
+        scores = np.concatenate(all_scores)
+        kept = non_max_suppression(positions, scores, max_overlap)
+
+    proposals = [(TaggedObject(name=object_name, position=position), score)
+                 for position, score in zip(positions[kept].tolist(),
+                                            scores[kept].tolist())]
+    return miniature.miniature_id, proposals
+
+
+def try_scan_miniature(miniature, model, *args, **kwargs):
+    """
+    Scan a miniature (see scan_miniature), returning the error instead of
+    raising it if it fails (for example, with a broken picture file).
+    Returns the miniature id, the proposals and the error.
+    """
+    try:
+        miniature_id, proposals = scan_miniature(miniature, model, *args,
+                                                 **kwargs)
+        return miniature_id, proposals, None
+    except Exception as err:
+        return miniature.miniature_id, [], err
+
+
+# model of each worker process, loaded once per process
+worker_model = None
+
+
+def load_worker_model(model_loader):
+    global worker_model
+    worker_model = model_loader()
+
+
+def scan_with_worker_model(miniature, *args, **kwargs):
+    return try_scan_miniature(miniature, worker_model, *args, **kwargs)
+
+
+def iter_scans(miniatures, model_loader, object_name, picture_size, scales,
+               workers=None, **scan_options):
+    """
+    Scan the miniatures (see scan_miniature) in this process, or in a pool of
+    processes if workers is specified (0 means one per cpu), yielding their
+    proposals (and the error, for the ones that failed) in order. model_loader is a picklable callable returning the
+    model, called once per process.
+    """
+    if workers is None:
+        model = model_loader()
+        for miniature in miniatures:
+            yield try_scan_miniature(miniature, model, object_name,
+                                     picture_size, scales, **scan_options)
+    else:
+        scan = partial(instrumentation.call_collecting, profiler.enabled,
+                       partial(scan_with_worker_model,
+                               object_name=object_name,
+                               picture_size=picture_size, scales=scales,
+                               **scan_options))
+        with ProcessPoolExecutor(max_workers=workers or None,
+                                 initializer=load_worker_model,
+                                 initargs=(model_loader,)) as executor:
+            results = executor.map(scan, miniatures, chunksize=4)
+            yield from instrumentation.merge_collected(results)
+
+
+def infer(object_name, model_loader, picture_size, scales, workers=None,
+          **scan_options):
+    """
+    Scan all the downloaded miniatures, replacing their proposed objects with
+    the given name in the objects store. Miniatures whose scan fails are
+    reported and skipped.
+    """
+    miniatures = [miniature for miniature in Miniature.all()
+                  if miniature.picture_path.exists()]
+    print('Scanning', len(miniatures), 'miniatures...')
+
+    store = objects_store.get()
+    total_proposals = failed = 0
+    scans = iter_scans(miniatures, model_loader, object_name, picture_size,
+                       scales, workers, **scan_options)
+    for miniature_id, proposals, err in scans:
+        if err is not None:
+            failed += 1
+            print('Miniature', miniature_id, 'failed:', err, flush=True)
+            continue
+
+        store.save_proposals(miniature_id, object_name,
+                             [(tagged_object.serialize(), score)
+                              for tagged_object, score in proposals])
+        total_proposals += len(proposals)
+
+    print('Proposed', total_proposals, object_name, 'objects,', failed,
+          'miniatures failed')
+
+
+def run(opts):
+    object_name = opts['OBJECT_NAME']
+    model_loader = partial(load_keras_model,
+                           os.path.abspath(opts['MODEL_PATH']))
+    picture_size = int(opts['PICTURE_SIZE'])
+    scales = [float(scale) for scale in opts['--scales'].split(',')]
+    workers = opts['--workers']
+    if workers is not None:
+        workers = int(workers)
+
+    with instrumentation.profiling(opts, 'infer_objects'):
+        infer(object_name, model_loader, picture_size, scales, workers,
+              stride=float(opts['--stride']),
+              threshold=float(opts['--threshold']),
+              max_overlap=float(opts['--max-overlap']),
+              batch_size=int(opts['--batch-size']))
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
@@ -0,0 +1,167 @@
+"""
+Lightweight instrumentation of the pipeline scripts: per-stage wall time,
+counters of items and bytes, and peak memory, saved as a json report.
+
+It's disabled by default (recording is then a no-op). Scripts enable it with
+their --profile option, by running their work inside profiling(opts, name).
+Stages recorded in pool workers are sent back to the main process when the
+work is run through call_collecting, so their times are added up across all
+the processes.
+"""
+import cProfile
+from contextlib import contextmanager
+import json
+import resource
+import sys
+import time
+
+import attr
+
+
+@attr.s
+class StageStats:
+    calls = attr.ib(default=0)
+    wall_time = attr.ib(default=0.0)
+    items = attr.ib(default=0)
+    bytes_read = attr.ib(default=0)
+    bytes_written = attr.ib(default=0)
+    peak_rss_kb = attr.ib(default=0)
+
+    def merge(self, other):
+        """
+        Add the stats recorded somewhere else (like another process).
+        """
+        self.calls += other.calls
+        self.wall_time += other.wall_time
+        self.items += other.items
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.peak_rss_kb = max(self.peak_rss_kb, other.peak_rss_kb)
+
+
+def peak_rss_kb():
+    """
+    Peak resident memory of this process so far (kilobytes on linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+
+    def stats(self, stage_name):
+        if stage_name not in self.stages:
+            self.stages[stage_name] = StageStats()
+        return self.stages[stage_name]
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        Time a block of code as (one call of) a stage.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stats(stage_name)
+            stats.calls += 1
+            stats.wall_time += time.perf_counter() - started_at
+            stats.peak_rss_kb = max(stats.peak_rss_kb, peak_rss_kb())
+
+    def count(self, stage_name, items=0, bytes_read=0, bytes_written=0):
+        """
+        Add to the counters of a stage.
+        """
+        if self.enabled:
+            stats = self.stats(stage_name)
+            stats.items += items
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+
+    def collect(self):
+        """
+        Take the stats recorded so far (to send them to another process).
+        """
+        stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages):
+        for stage_name, stats in stages.items():
+            self.stats(stage_name).merge(stats)
+
+    def report(self):
+        return {
+            'stages': {stage_name: attr.asdict(stats)
+                       for stage_name, stats in self.stages.items()},
+            'peak_rss_kb': peak_rss_kb(),
+            'children_peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+
+profiler = Profiler()
+stage = profiler.stage
+count = profiler.count
+
+
+def call_collecting(enabled, function, *args):
+    """
+    Call a function (usually in a pool worker), returning its result along
+    with the stats it recorded. Stats inherited from a forked parent process
+    are discarded first, so they aren't counted twice.
+    """
+    profiler.enabled = enabled
+    profiler.collect()
+    result = function(*args)
+    return result, profiler.collect()
+
+
+def merge_collected(results):
+    """
+    Unwrap the results of call_collecting, merging their stats into the stats
+    of this process.
+    """
+    for result, stages in results:
+        profiler.merge(stages)
+        yield result
+
+
+@contextmanager
+def profiling(opts, script_name):
+    """
+    Run the body of a script, profiling it if the --profile option was used,
+    and saving the report (and the cProfile stats, if requested) at the end.
+    """
+    if not opts.get('--profile'):
+        yield
+        return
+
+    profiler.enabled = True
+    cprofile_path = opts.get('--cprofile')
+    if cprofile_path:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        if cprofile_path:
+            cprofile.disable()
+            cprofile.dump_stats(cprofile_path)
+
+        report = dict(profiler.report(),
+                      script=script_name,
+                      argv=sys.argv[1:],
+                      started_at=started_at,
+                      wall_time=time.time() - started_at)
+        with open(opts['--profile-report'], 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+        print('Profile report saved to', opts['--profile-report'])
@@ -0,0 +1,46 @@
+"""
+Merge the outputs of a sharded run (see shards.py) into the regular outputs,
+once all the shards are done and their files were gathered in the data dir:
+the download manifests, the manifests of sets (their crops are already in the
+set dirs), or the dataframes or tensor files of a set.
+
+Usage:
+    merge_shards.py downloads SHARDS_COUNT
+    merge_shards.py set OBJECT_NAME SHARDS_COUNT
+    merge_shards.py dataframe OBJECT_NAME SHARDS_COUNT PICTURE_SIZE... [options]
+
+Arguments:
+    OBJECT_NAME             the name of the object (or several, separated by
+                            commas).
+    SHARDS_COUNT            in how many shards the run was split.
+    PICTURE_SIZE            the size of the pictures inside the dataframe.
+
+Options:
+    --format=FORMAT         "dataframe" or "tensor" (see generate_dataframe.py)
+                            [default: dataframe].
+"""
+from docopt import docopt
+
+
+def run(opts):
+    shards_count = int(opts['SHARDS_COUNT'])
+
+    # only import what's needed for the kind of output being merged
+    if opts['downloads']:
+        import download_pictures
+        download_pictures.merge_manifests(shards_count)
+    elif opts['set']:
+        import generate_set
+        for object_name in opts['OBJECT_NAME'].split(','):
+            generate_set.merge_manifests(object_name, shards_count)
+    else:
+        import generate_dataframe
+        picture_sizes = [int(picture_size)
+                         for picture_size in opts['PICTURE_SIZE']]
+        for object_name in opts['OBJECT_NAME'].split(','):
+            generate_dataframe.merge_outputs(object_name, picture_sizes,
+                                             shards_count, opts['--format'])
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
@@ -0,0 +1,336 @@
+"""
+Compact binary index of the miniatures metadata csv.
+
+The csv is parsed once into a fixed size record per miniature (ids and years)
+plus a blob with the file names and tags, and saved next to the csv. Later
+loads just memory map that file, and it's only rebuilt when the csv changes.
+
+Queries by tags and years go through a QueryIndex (an inverted index of the
+tags, and the miniatures sorted by year), built once per process from the
+index.
+"""
+from collections import defaultdict
+import hashlib
+import json
+import mmap
+import struct
+
+import numpy as np
+
+import settings
+
+
+INDEX_MAGIC = b'MMINDEX1'
+INDEX_HEADER_LENGTH = struct.Struct('<I')
+INDEX_ALIGNMENT = 8
+NO_YEAR = np.iinfo(np.int32).min
+STRINGS_SEPARATOR = '\x1f'
+
+RECORDS_DTYPE = np.dtype([
+    ('manuscript_id', '<i8'),
+    ('miniature_id', '<i8'),
+    ('start_year', '<i4'),
+    ('end_year', '<i4'),
+    ('strings_offset', '<u4'),
+    ('strings_length', '<u4'),
+])
+
+
+def parse_year(text):
+    """
+    Parse a year field from the metadata csv (either a number or None).
+    """
+    if text == 'None':
+        return None
+    return int(text)
+
+
+def parse_metadata(lines):
+    """
+    Parse lines of the metadata csv, yielding a tuple of (manuscript_id,
+    miniature_id, file_name, start_year, end_year, tags) for each miniature
+    (ignoring bad lines in the csv).
+    """
+    for line in lines:
+        fields = [field.strip()
+                  for field in line.split(',')
+                  if field.strip()]
+
+        if len(fields) > 4:
+            tags = [tag.lower() for tag in fields[5:]]
+            yield (int(fields[0]), int(fields[1]), fields[2],
+                   parse_year(fields[3]), parse_year(fields[4]), tags)
+
+
+def file_hash(path):
+    """
+    Hash the contents of a file, reading it in chunks.
+    """
+    digest = hashlib.sha1()
+    with path.open('rb') as the_file:
+        for chunk in iter(lambda: the_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MetadataIndex:
+    """
+    Memory mapped view over an index file.
+    """
+    def __init__(self, index_path):
+        with index_path.open('rb') as index_file:
+            self.buffer = mmap.mmap(index_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+
+        magic_end = len(INDEX_MAGIC)
+        if self.buffer[:magic_end] != INDEX_MAGIC:
+            raise ValueError('Not a metadata index: {}'.format(index_path))
+
+        header_start = magic_end + INDEX_HEADER_LENGTH.size
+        header_length, = INDEX_HEADER_LENGTH.unpack_from(self.buffer,
+                                                         magic_end)
+        self.header = json.loads(
+            self.buffer[header_start:header_start + header_length].decode())
+
+        records_start = self.header['records_start']
+        self.records = np.frombuffer(self.buffer, dtype=RECORDS_DTYPE,
+                                     count=self.header['count'],
+                                     offset=records_start)
+        self.strings_start = records_start + self.records.nbytes
+
+    def __len__(self):
+        return len(self.records)
+
+    def strings(self, position):
+        """
+        Get the file name and tags of the miniature at a given position.
+        """
+        record = self.records[position]
+        start = self.strings_start + int(record['strings_offset'])
+        end = start + int(record['strings_length'])
+        file_name, *tags = self.buffer[start:end].decode().split(
+            STRINGS_SEPARATOR)
+        return file_name, tags
+
+    def row(self, position, record=None):
+        """
+        Get the miniature at a given position, as the same tuple that
+        parse_metadata produces.
+        """
+        if record is None:
+            record = self.records[position].tolist()
+        manuscript_id, miniature_id, start_year, end_year, _, _ = record
+        file_name, tags = self.strings(position)
+        return (manuscript_id, miniature_id, file_name,
+                None if start_year == NO_YEAR else start_year,
+                None if end_year == NO_YEAR else end_year,
+                tags)
+
+    def __iter__(self):
+        """
+        Yield the same tuples that parse_metadata produces.
+        """
+        for position, record in enumerate(self.records.tolist()):
+            yield self.row(position, record)
+
+
+class QueryIndex:
+    """
+    Inverted index of the tags of the miniatures of an index (tag -> sorted
+    array of positions), plus their positions sorted by year, so selecting
+    miniatures doesn't require scanning all of them.
+    """
+    def __init__(self, index):
+        positions_by_tag = defaultdict(list)
+        for position in range(len(index)):
+            _, tags = index.strings(position)
+            for tag in set(tags):
+                positions_by_tag[tag].append(position)
+        self.positions_by_tag = {
+            tag: np.array(positions, dtype=np.int64)
+            for tag, positions in positions_by_tag.items()}
+
+        # when only one of the years is known, it's used as both ends
+        start_years = index.records['start_year']
+        end_years = index.records['end_year']
+        start_years, end_years = (
+            np.where(start_years == NO_YEAR, end_years, start_years),
+            np.where(end_years == NO_YEAR, start_years, end_years))
+
+        dated = np.flatnonzero(start_years != NO_YEAR)
+        self.positions_by_start = dated[np.argsort(start_years[dated],
+                                                   kind='stable')]
+        self.sorted_start_years = start_years[self.positions_by_start]
+        self.end_years = end_years
+
+        self.miniature_ids = index.records['miniature_id']
+        self.positions_by_id = np.argsort(self.miniature_ids, kind='stable')
+        self.sorted_ids = self.miniature_ids[self.positions_by_id]
+
+    def tag_positions(self, tag):
+        return self.positions_by_tag.get(tag.lower(),
+                                         np.empty(0, dtype=np.int64))
+
+    def year_positions(self, from_year=None, to_year=None):
+        """
+        Sorted positions of the miniatures whose years overlap a range (either
+        end can be None, for an open range). Undated miniatures are excluded.
+        """
+        if to_year is None:
+            candidates = self.positions_by_start
+        else:
+            count = np.searchsorted(self.sorted_start_years, to_year,
+                                    side='right')
+            candidates = self.positions_by_start[:count]
+
+        if from_year is not None:
+            candidates = candidates[self.end_years[candidates] >= from_year]
+
+        return np.sort(candidates)
+
+    def id_positions(self, miniature_ids):
+        """
+        Sorted positions of the miniatures with some ids (unknown ids are
+        ignored).
+        """
+        miniature_ids = np.asarray(list(miniature_ids), dtype=np.int64)
+        found = np.searchsorted(self.sorted_ids, miniature_ids)
+        found = found[found < len(self.sorted_ids)]
+        found = found[np.isin(self.sorted_ids[found], miniature_ids)]
+        return np.unique(self.positions_by_id[found])
+
+    def positions(self, tags=None, any_tags=None, years=None,
+                  miniature_ids=None):
+        """
+        Sorted positions of the miniatures having all the tags, at least one
+        of any_tags, years overlapping a (from, to) range and one of the ids
+        (every criteria is optional).
+        """
+        selections = []
+        for tag in tags or ():
+            selections.append(self.tag_positions(tag))
+        if any_tags is not None:
+            selections.append(np.unique(np.concatenate(
+                [self.tag_positions(tag) for tag in any_tags] +
+                [np.empty(0, dtype=np.int64)])))
+        if years is not None:
+            selections.append(self.year_positions(*years))
+        if miniature_ids is not None:
+            selections.append(self.id_positions(miniature_ids))
+
+        if not selections:
+            return np.arange(len(self.miniature_ids))
+
+        # intersect the smallest selections first
+        selections.sort(key=len)
+        positions = selections[0]
+        for selection in selections[1:]:
+            positions = np.intersect1d(positions, selection,
+                                       assume_unique=True)
+        return positions
+
+
+_query_indexes = {}
+
+
+def query_index(index):
+    """
+    Get the query index of a metadata index, building it only once per
+    process (until the csv changes).
+    """
+    key = (index.header['csv_hash'], len(index))
+    if key not in _query_indexes:
+        _query_indexes.clear()
+        _query_indexes[key] = QueryIndex(index)
+    return _query_indexes[key]
+
+
+def write_index(index_path, header, records, strings):
+    """
+    Write the index file, atomically replacing the previous one.
+    """
+    header = dict(header, count=len(records))
+    records_start = 0
+    while True:
+        # the header contains its own length, so iterate until it's stable
+        header['records_start'] = records_start
+        raw_header = json.dumps(header).encode()
+        header_end = (len(INDEX_MAGIC) + INDEX_HEADER_LENGTH.size +
+                      len(raw_header))
+        padding = -header_end % INDEX_ALIGNMENT
+        if header_end + padding == records_start:
+            break
+        records_start = header_end + padding
+
+    partial_path = index_path.with_name(index_path.name + '.part')
+    with partial_path.open('wb') as index_file:
+        index_file.write(INDEX_MAGIC)
+        index_file.write(INDEX_HEADER_LENGTH.pack(len(raw_header)))
+        index_file.write(raw_header)
+        index_file.write(b'\0' * padding)
+        index_file.write(records.tobytes())
+        index_file.write(strings)
+    partial_path.replace(index_path)
+
+
+def build_index(csv_path, index_path, header):
+    """
+    Parse the csv and save its index.
+    """
+    with csv_path.open() as csv_file:
+        parsed = list(parse_metadata(csv_file))
+
+    records = np.zeros(len(parsed), dtype=RECORDS_DTYPE)
+    strings = bytearray()
+    for position, miniature_data in enumerate(parsed):
+        (manuscript_id, miniature_id, file_name,
+         start_year, end_year, tags) = miniature_data
+
+        raw_strings = STRINGS_SEPARATOR.join([file_name] + tags).encode()
+        records[position] = (
+            manuscript_id, miniature_id,
+            NO_YEAR if start_year is None else start_year,
+            NO_YEAR if end_year is None else end_year,
+            len(strings), len(raw_strings),
+        )
+        strings.extend(raw_strings)
+
+    write_index(index_path, header, records, bytes(strings))
+
+
+def load(csv_path=None, index_path=None):
+    """
+    Load the metadata index, (re)building it first when it's missing or the
+    csv changed since it was built.
+    """
+    if csv_path is None:
+        csv_path = settings.METADATA_CSV_PATH
+    if index_path is None:
+        index_path = settings.METADATA_INDEX_PATH
+
+    csv_stat = csv_path.stat()
+    header = {
+        'csv_mtime_ns': csv_stat.st_mtime_ns,
+        'csv_size': csv_stat.st_size,
+    }
+
+    index = None
+    if index_path.exists():
+        try:
+            index = MetadataIndex(index_path)
+        except ValueError:
+            index = None
+
+    if index is not None:
+        if all(index.header[key] == value for key, value in header.items()):
+            return index
+
+    # only touched, or really changed?
+    header['csv_hash'] = file_hash(csv_path)
+    if index is not None and index.header['csv_hash'] == header['csv_hash']:
+        strings = index.buffer[index.strings_start:]
+        write_index(index_path, header, index.records, strings)
+    else:
+        build_index(csv_path, index_path, header)
+
+    return MetadataIndex(index_path)
@@ -0,0 +1,199 @@
+"""
+Columnar in-memory table of the miniatures: ids and years in numpy arrays,
+tags as ids into a shared vocabulary, and (once loaded) the tagged objects as
+a (n, 4) int32 array of positions, with the row of their miniature and the id
+of their name. It takes a fraction of the memory of a list of Miniature
+instances, and rectangle math can run over whole columns at once. Miniature
+instances are only built when needed.
+"""
+import numpy as np
+from PIL import Image
+
+from core import Miniature, TaggedObject
+from generate_set import rectangles_overlap_matrix, rectangles_to_squares
+import metadata_index
+import objects_store
+import settings
+
+
+class MiniatureTable:
+    def __init__(self, index=None, positions=None):
+        """
+        Build the table from the metadata index, with all the miniatures or
+        only the ones at some positions (like the result of a query).
+        """
+        if index is None:
+            index = metadata_index.load()
+        if positions is None:
+            positions = np.arange(len(index))
+
+        records = index.records[positions]
+        self.manuscript_ids = records['manuscript_id']
+        self.miniature_ids = records['miniature_id']
+        self.start_years = records['start_year']
+        self.end_years = records['end_year']
+
+        file_names = []
+        self.tag_names = []
+        tag_ids_by_name = {}
+        tag_ids = []
+        tags_offsets = [0]
+        for position in np.asarray(positions).tolist():
+            file_name, tags = index.strings(position)
+            file_names.append(file_name)
+            for tag in tags:
+                if tag not in tag_ids_by_name:
+                    tag_ids_by_name[tag] = len(self.tag_names)
+                    self.tag_names.append(tag)
+                tag_ids.append(tag_ids_by_name[tag])
+            tags_offsets.append(len(tag_ids))
+
+        self.file_names = np.array(file_names, dtype=str)
+        self.tag_ids = np.array(tag_ids, dtype=np.int32)
+        self.tags_offsets = np.array(tags_offsets, dtype=np.int64)
+
+        self.rows_by_id = np.argsort(self.miniature_ids, kind='stable')
+        self.sorted_ids = self.miniature_ids[self.rows_by_id]
+
+        self.object_names = []
+        self.object_rows = np.empty(0, dtype=np.int32)
+        self.object_name_ids = np.empty(0, dtype=np.int32)
+        self.object_positions = np.empty((0, 4), dtype=np.int32)
+
+    @classmethod
+    def query(cls, tags=None, any_tags=None, years=None, miniature_ids=None):
+        """
+        Build a table with only the miniatures matching a query (see
+        Miniature.query).
+        """
+        index = metadata_index.load()
+        positions = metadata_index.query_index(index).positions(
+            tags, any_tags, years, miniature_ids)
+        return cls(index, positions)
+
+    def __len__(self):
+        return len(self.miniature_ids)
+
+    def rows_of(self, miniature_ids):
+        """
+        Rows of the miniatures with some ids (-1 for unknown ids).
+        """
+        miniature_ids = np.asarray(miniature_ids, dtype=np.int64)
+        if not len(self.sorted_ids):
+            return np.full(len(miniature_ids), -1, dtype=np.int64)
+
+        found = np.searchsorted(self.sorted_ids, miniature_ids)
+        found = np.minimum(found, len(self.sorted_ids) - 1)
+        rows = self.rows_by_id[found]
+        return np.where(self.sorted_ids[found] == miniature_ids, rows, -1)
+
+    def tags(self, row):
+        tag_ids = self.tag_ids[self.tags_offsets[row]:
+                               self.tags_offsets[row + 1]]
+        return tuple(self.tag_names[tag_id] for tag_id in tag_ids.tolist())
+
+    def year(self, years, row):
+        year = int(years[row])
+        return None if year == metadata_index.NO_YEAR else year
+
+    def miniature(self, row):
+        """
+        Build the Miniature instance of a row (without its objects).
+        """
+        return Miniature(
+            manuscript_id=int(self.manuscript_ids[row]),
+            miniature_id=int(self.miniature_ids[row]),
+            file_name=str(self.file_names[row]),
+            start_year=self.year(self.start_years, row),
+            end_year=self.year(self.end_years, row),
+            tags=self.tags(row),
+        )
+
+    def __getitem__(self, row):
+        return self.miniature(row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.miniature(row)
+
+    def load_objects(self, object_name=None):
+        """
+        Load the tagged objects of the miniatures in the table (all of them,
+        or only the ones with a given name) from the objects store.
+        """
+        stored = objects_store.get().objects(object_name)
+        rows = self.rows_of([miniature_id for miniature_id, _, _ in stored])
+        in_table = rows >= 0
+
+        names = [name for _, name, _ in stored]
+        self.object_names = sorted(set(names))
+        name_ids = {name: name_id
+                    for name_id, name in enumerate(self.object_names)}
+
+        self.object_rows = rows[in_table].astype(np.int32)
+        self.object_name_ids = np.array(
+            [name_ids[name] for name in names],
+            dtype=np.int32).reshape(-1)[in_table]
+        self.object_positions = np.array(
+            [position for _, _, position in stored],
+            dtype=np.int32).reshape(-1, 4)[in_table]
+
+    def objects_of(self, row):
+        """
+        Get the loaded objects of a row, as TaggedObject instances.
+        """
+        selected = np.flatnonzero(self.object_rows == row)
+        return [TaggedObject(name=self.object_names[name_id],
+                             position=position)
+                for name_id, position in zip(
+                    self.object_name_ids[selected].tolist(),
+                    self.object_positions[selected].tolist())]
+
+    def objects_with_name(self, object_name):
+        """
+        Indexes (in the objects columns) of the loaded objects with a name.
+        """
+        if object_name not in self.object_names:
+            return np.empty(0, dtype=np.int64)
+        name_id = self.object_names.index(object_name)
+        return np.flatnonzero(self.object_name_ids == name_id)
+
+    def picture_sizes(self):
+        """
+        Read the (width, height) of the pictures of all the rows, from their
+        headers, as a (n, 2) array (zeros for the missing pictures).
+        """
+        sizes = np.zeros((len(self), 2), dtype=np.int32)
+        for row, file_name in enumerate(self.file_names.tolist()):
+            picture_path = settings.PICTURES_DIR / file_name
+            if picture_path.exists():
+                with Image.open(str(picture_path)) as picture:
+                    sizes[row] = picture.size
+        return sizes
+
+    def object_squares(self, picture_sizes, objects=None):
+        """
+        Squares of the loaded objects (all of them, or the ones at some
+        indexes), as generate_set would crop them, given the picture sizes of
+        all the rows.
+        """
+        if objects is None:
+            objects = np.arange(len(self.object_rows))
+        rows = self.object_rows[objects]
+        return rectangles_to_squares(self.object_positions[objects],
+                                     picture_sizes[rows, 0],
+                                     picture_sizes[rows, 1])
+
+    def objects_overlapping(self, row, rectangles, object_name=None):
+        """
+        Tell which of a (n, 4) array of rectangles overlap a loaded object
+        (with a given name, if specified) of a row.
+        """
+        if object_name is None:
+            objects = np.flatnonzero(self.object_rows == row)
+        else:
+            objects = self.objects_with_name(object_name)
+            objects = objects[self.object_rows[objects] == row]
+
+        return rectangles_overlap_matrix(
+            rectangles, self.object_positions[objects]).any(axis=1)
@@ -0,0 +1,76 @@
+"""
+Single entry point for all the scripts of the project. The module of a
+command (and its heavy dependencies) is only imported once its arguments
+are valid, so help messages and argument errors are instant.
+
+Usage:
+    miniatures.py COMMAND [ARGS...]
+    miniatures.py (-h | --help)
+
+Commands:
+    download                download the pictures (download_pictures.py).
+    build-thumbnails        build the thumbnails pyramid (build_thumbnails.py).
+    query                   list miniatures by tags and years
+                            (query_miniatures.py).
+    tag                     tag objects in miniatures (tag_objects.py).
+    generate-set            generate an object-or-not set (generate_set.py).
+    generate-dataframe      build dataframes or tensors of a set
+                            (generate_dataframe.py).
+    generate-tensor         crop a set straight into a tensor file
+                            (generate_tensor.py).
+    infer                   propose objects with a trained model
+                            (infer_objects.py).
+    merge-shards            merge the outputs of a sharded run
+                            (merge_shards.py).
+
+Run "miniatures.py COMMAND --help" for the options of each command.
+"""
+import ast
+import importlib
+from pathlib import Path
+import sys
+
+from docopt import docopt
+
+
+COMMANDS = {
+    'download': 'download_pictures',
+    'build-thumbnails': 'build_thumbnails',
+    'query': 'query_miniatures',
+    'tag': 'tag_objects',
+    'generate-set': 'generate_set',
+    'generate-dataframe': 'generate_dataframe',
+    'generate-tensor': 'generate_tensor',
+    'infer': 'infer_objects',
+    'merge-shards': 'merge_shards',
+}
+
+
+def command_doc(command):
+    """
+    Get the docstring of the module of a command, reading its source instead
+    of importing it.
+    """
+    module_name = COMMANDS[command]
+    module_path = Path(__file__).parent / (module_name + '.py')
+    doc = ast.get_docstring(ast.parse(module_path.read_text()), clean=False)
+    return doc.replace(module_name + '.py',
+                       'miniatures.py {}'.format(command))
+
+
+def main(argv=None):
+    opts = docopt(__doc__, argv, options_first=True)
+    command = opts['COMMAND']
+    if command not in COMMANDS:
+        sys.exit('Unknown command: {} (see miniatures.py --help)'.format(
+            command))
+
+    # the usage of the command doc starts with the command name now
+    command_opts = docopt(command_doc(command), [command] + opts['ARGS'])
+
+    module = importlib.import_module(COMMANDS[command])
+    module.run(command_opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Consolidated store of the tagged objects of all the miniatures.
+
+The json files in the objects dir are still the source of truth (one per
+miniature), but their contents are mirrored in a single sqlite database indexed
+by object name, so finding which miniatures have some object doesn't require
+opening every json file.
+
+The database also keeps the objects proposed by infer_objects.py (with their
+scores), apart from the tagged ones, so they never end up in training sets
+unless someone confirms them.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+import settings
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    miniature_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    from_x INTEGER NOT NULL,
+    from_y INTEGER NOT NULL,
+    to_x INTEGER NOT NULL,
+    to_y INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_by_name ON objects (name, miniature_id);
+CREATE INDEX IF NOT EXISTS objects_by_miniature ON objects (miniature_id);
+CREATE TABLE IF NOT EXISTS proposals (
+    miniature_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    from_x INTEGER NOT NULL,
+    from_y INTEGER NOT NULL,
+    to_x INTEGER NOT NULL,
+    to_y INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS proposals_by_miniature
+    ON proposals (miniature_id, name);
+CREATE TABLE IF NOT EXISTS sources (
+    miniature_id INTEGER PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+'''
+
+
+class ObjectsStore:
+    def __init__(self, db_path, objects_dir):
+        self.objects_dir = objects_dir
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(db_path),
+                                          check_same_thread=False)
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def sync(self):
+        """
+        Import the json files that changed (or were removed) since they were
+        last seen by the store. Only lists the objects dir, no json file is
+        opened unless it changed.
+        """
+        with self.lock:
+            known = dict(self.connection.execute(
+                'SELECT miniature_id, mtime_ns FROM sources'))
+
+            present = {}
+            with os.scandir(str(self.objects_dir)) as entries:
+                for entry in entries:
+                    stem, extension = os.path.splitext(entry.name)
+                    if extension == '.json' and stem.isdigit():
+                        present[int(stem)] = entry
+
+            with self.connection:
+                for miniature_id in known.keys() - present.keys():
+                    self._replace(miniature_id, [], None)
+
+                for miniature_id, entry in present.items():
+                    mtime_ns = entry.stat().st_mtime_ns
+                    if known.get(miniature_id) != mtime_ns:
+                        with open(entry.path) as objects_file:
+                            raw_objects = json.load(objects_file)
+                        self._replace(miniature_id, raw_objects, mtime_ns)
+
+    def _replace(self, miniature_id, raw_objects, mtime_ns):
+        """
+        Replace all the objects of a miniature (must hold the lock, and be
+        inside a transaction).
+        """
+        self.connection.execute('DELETE FROM objects WHERE miniature_id = ?',
+                                (miniature_id,))
+        self.connection.executemany(
+            'INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+            [(miniature_id, name, *position)
+             for name, position in raw_objects])
+
+        if mtime_ns is None:
+            self.connection.execute(
+                'DELETE FROM sources WHERE miniature_id = ?', (miniature_id,))
+        else:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                (miniature_id, mtime_ns))
+
+    def save(self, miniature_id, raw_objects, mtime_ns):
+        """
+        Update the objects of one miniature, after its json file was written.
+        """
+        with self.lock, self.connection:
+            self._replace(miniature_id, raw_objects, mtime_ns)
+
+    def load(self, miniature_id):
+        """
+        Get the serialized objects of one miniature.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, from_x, from_y, to_x, to_y FROM objects '
+                'WHERE miniature_id = ? ORDER BY rowid', (miniature_id,))
+            return [(name, list(position)) for name, *position in rows]
+
+    def miniature_ids_with(self, object_name):
+        """
+        Ids of the miniatures having at least one object with a given name.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT miniature_id FROM objects WHERE name = ?',
+                (object_name,))
+            return [miniature_id for miniature_id, in rows]
+
+    def object_names(self):
+        """
+        Names of all the tagged objects.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT name FROM objects ORDER BY name')
+            return [name for name, in rows]
+
+    def objects(self, object_name=None):
+        """
+        Get (miniature_id, name, position) for all the objects, or only the
+        ones with a given name.
+        """
+        query = ('SELECT miniature_id, name, from_x, from_y, to_x, to_y '
+                 'FROM objects')
+        parameters = ()
+        if object_name is not None:
+            query += ' WHERE name = ?'
+            parameters = (object_name,)
+
+        with self.lock:
+            rows = self.connection.execute(
+                query + ' ORDER BY miniature_id, rowid', parameters)
+            return [(miniature_id, name, list(position))
+                    for miniature_id, name, *position in rows]
+
+    def save_proposals(self, miniature_id, object_name, proposals):
+        """
+        Replace the proposed objects with a given name of one miniature, given
+        as (serialized object, score) pairs.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM proposals WHERE miniature_id = ? AND name = ?',
+                (miniature_id, object_name))
+            self.connection.executemany(
+                'INSERT INTO proposals VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(miniature_id, name, *position, score)
+                 for (name, position), score in proposals])
+
+    def load_proposals(self, miniature_id):
+        """
+        Get the proposed objects of one miniature, as (serialized object,
+        score) pairs, best scores first.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT name, from_x, from_y, to_x, to_y, score '
+                'FROM proposals WHERE miniature_id = ? ORDER BY score DESC',
+                (miniature_id,))
+            return [((name, [from_x, from_y, to_x, to_y]), score)
+                    for name, from_x, from_y, to_x, to_y, score in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_store = None
+_store_pid = None
+
+
+def get():
+    """
+    Get the store for the configured paths, synced with the objects dir. The
+    store is opened once per process (sqlite connections can't be shared with
+    forked workers).
+    """
+    global _store, _store_pid
+
+    if _store is None or _store_pid != os.getpid():
+        _store = ObjectsStore(settings.OBJECTS_DB_PATH, settings.OBJECTS_DIR)
+        _store_pid = os.getpid()
+        _store.sync()
+
+    return _store
@@ -0,0 +1,130 @@
+"""
+Cache of downscaled miniatures pictures, for displaying them in the tagger.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+
+import attr
+import numpy as np
+from PIL import Image
+
+import settings
+import thumbnails
+
+
+@attr.s
+class DisplayPicture:
+    pixels = attr.ib()
+    original_size = attr.ib()
+    using_real_picture = attr.ib()
+
+
+def load_display_picture(picture_path, display_size):
+    """
+    Decode a picture reduced to fit in a display_size square (from the
+    smallest thumbnail that is big enough, or using the reduced jpeg decoding
+    when possible), remembering its original size so positions can be mapped
+    back to it.
+    """
+    with Image.open(str(picture_path)) as original:
+        # only reads the header
+        original_size = original.size
+
+    width, height = original_size
+    min_size = math.ceil(display_size * min(width, height) /
+                         max(width, height))
+
+    with thumbnails.open_at_least(picture_path, picture_path.name,
+                                  min_size) as picture:
+        picture.thumbnail((display_size, display_size), Image.LANCZOS)
+        if picture.mode != 'RGB':
+            picture = picture.convert('RGB')
+        pixels = np.asarray(picture)
+
+    return pixels, original_size
+
+
+class PictureCache:
+    """
+    LRU cache of display pictures of miniatures, which can be filled in
+    advance by a background thread.
+    """
+    def __init__(self, display_size=None, max_items=None):
+        if display_size is None:
+            display_size = settings.DISPLAY_PICTURE_SIZE
+        if max_items is None:
+            max_items = settings.PICTURE_CACHE_SIZE
+
+        self.display_size = display_size
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def load(self, miniature):
+        """
+        Decode the display picture of a miniature (or the empty picture, if
+        it's not available).
+        """
+        try:
+            pixels, original_size = load_display_picture(
+                miniature.picture_path, self.display_size)
+            return DisplayPicture(pixels, original_size, True)
+        except Exception:
+            pixels, original_size = load_display_picture(
+                settings.EMPTY_PICTURE_PATH, self.display_size)
+            return DisplayPicture(pixels, original_size, False)
+
+    def store(self, miniature_id, display_picture):
+        """
+        Add a display picture, evicting the least recently used ones.
+        """
+        with self.lock:
+            self.items[miniature_id] = display_picture
+            self.items.move_to_end(miniature_id)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+            self.pending.pop(miniature_id, None)
+
+    def get(self, miniature):
+        """
+        Get the display picture of a miniature, waiting for it if it's being
+        prefetched, or decoding it right away if it isn't.
+        """
+        with self.lock:
+            display_picture = self.items.get(miniature.miniature_id)
+            if display_picture is not None:
+                self.items.move_to_end(miniature.miniature_id)
+                return display_picture
+            future = self.pending.get(miniature.miniature_id)
+
+        if future is not None:
+            return future.result()
+
+        display_picture = self.load(miniature)
+        self.store(miniature.miniature_id, display_picture)
+        return display_picture
+
+    def prefetch(self, miniatures):
+        """
+        Start decoding the display pictures of some miniatures in the
+        background, unless they are already cached or being prefetched.
+        """
+        for miniature in miniatures:
+            with self.lock:
+                if (miniature.miniature_id in self.items or
+                        miniature.miniature_id in self.pending):
+                    continue
+                future = self.executor.submit(self.prefetch_one, miniature)
+                self.pending[miniature.miniature_id] = future
+
+    def prefetch_one(self, miniature):
+        display_picture = self.load(miniature)
+        self.store(miniature.miniature_id, display_picture)
+        return display_picture
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,52 @@
+"""
+List the miniatures matching some tags and years, from the metadata index.
+
+Usage:
+    query_miniatures.py [options]
+
+Options:
+    --tags=TAGS             comma separated tags the miniatures must all have.
+    --any-tags=TAGS         comma separated tags the miniatures must have at
+                            least one of.
+    --years=FROM:TO         range of years overlapping the ones of the
+                            miniatures (either end can be left empty).
+    --count                 only print how many miniatures match.
+"""
+from docopt import docopt
+
+from core import Miniature
+
+
+def parse_tags(text):
+    if text is None:
+        return None
+    return [tag.strip() for tag in text.split(',') if tag.strip()]
+
+
+def parse_years(text):
+    """
+    Parse a FROM:TO range of years (either end can be empty).
+    """
+    if text is None:
+        return None
+    from_year, to_year = (int(year) if year.strip() else None
+                          for year in text.split(':'))
+    return from_year, to_year
+
+
+def run(opts):
+    miniatures = Miniature.query(tags=parse_tags(opts['--tags']),
+                                 any_tags=parse_tags(opts['--any-tags']),
+                                 years=parse_years(opts['--years']))
+
+    if opts['--count']:
+        print(sum(1 for _ in miniatures))
+    else:
+        for miniature in miniatures:
+            print(miniature.miniature_id, miniature.file_name,
+                  miniature.start_year, miniature.end_year,
+                  ', '.join(miniature.tags), sep='\t')
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
@@ -1,13 +1,41 @@
+import os
 from pathlib import Path
 
-# general settings
-PICTURE_URL = 'http://manuscriptminiatures.com/media/manuscriptminiatures.com/original/{}'
-PICTURES_DIR = Path('./data/pictures/')
-METADATA_CSV_PATH = Path('./data/miniatures_metadata.csv')
-OBJECTS_DIR = Path('./data/objects/')
-OBJECTS_PICTURES_SETS_DIR = Path('./data/object_picture_sets/')
+# general settings (the data dir and pictures url can be overridden with env
+# vars, to point the scripts to other corpora, like the benchmark ones)
+PICTURE_URL = os.environ.get(
+    'MINIATURES_PICTURE_URL',
+    'http://manuscriptminiatures.com/media/manuscriptminiatures.com/original/{}')
+DATA_DIR = Path(os.environ.get('MINIATURES_DATA_DIR', './data/'))
+PICTURES_DIR = DATA_DIR / 'pictures'
+DOWNLOAD_MANIFEST_PATH = DATA_DIR / 'download_manifest.json'
+METADATA_CSV_PATH = DATA_DIR / 'miniatures_metadata.csv'
+METADATA_INDEX_PATH = DATA_DIR / 'miniatures_metadata.idx'
+OBJECTS_DIR = DATA_DIR / 'objects'
+OBJECTS_DB_PATH = DATA_DIR / 'objects.sqlite'
+OBJECTS_PICTURES_SETS_DIR = DATA_DIR / 'object_picture_sets'
+THUMBNAILS_DIR = DATA_DIR / 'thumbnails'
+THUMBNAIL_LEVELS = (128, 256, 512, 1024)  # shortest side of each level
+
+# pictures downloader
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_TIMEOUT = 30  # seconds, for connecting and between received chunks
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1  # seconds, doubled after each failed attempt
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_MANIFEST_SAVE_INTERVAL = 100  # save the manifest after these files
+
+# sets generation
+NEGATIVES_ATTEMPTS_PER_EXAMPLE = 100  # random squares tried per negative
+MANIFEST_SAVE_INTERVAL = 100  # save the set manifest after these miniatures
 
 # objects tagger
 OBJECT_PREVIEW_PATH = Path('./last_object_preview.png')
 LAST_TAGGED_OBJECTS_PATH = Path('./last_tagged_objects.json')
+TAG_JOURNAL_PATH = DATA_DIR / 'tag_journal.jsonl'
+TAG_JOURNAL_FLUSH_INTERVAL = 1  # seconds between journal fsyncs and flushes
 EMPTY_PICTURE_PATH = PICTURES_DIR / 'no_picture.png'
+DISPLAY_PICTURE_SIZE = 1600  # pixels, the longest side of displayed pictures
+PICTURE_CACHE_SIZE = 16  # how many display pictures to keep in memory
+PREFETCH_DISTANCE = 2  # how many pictures to prefetch in each direction
+SELECTION_REDRAW_INTERVAL = 1 / 60  # seconds, between selection redraws
@@ -0,0 +1,71 @@
+"""
+Deterministic partition of the miniatures into shards, so the downloads, set
+generation and dataframe building can be spread across several machines.
+Shard "i/N" (with i from 0 to N - 1) has the miniatures whose id hashes to
+i modulo N, so every miniature always lands in the same shard, no matter the
+machine, the python process or the order of the metadata. Each shard writes
+its outputs next to the regular ones, with a .shard-i-of-N suffix, and
+merge_shards.py combines them.
+"""
+import hashlib
+
+
+def parse_shard(text):
+    """
+    Parse an "i/N" shard (None stays None).
+    """
+    if text is None:
+        return None
+
+    try:
+        index, count = (int(number) for number in text.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard {!r}, expected i/N'.format(text))
+    if not 0 <= index < count:
+        raise ValueError('Invalid shard {!r}, i must be between 0 and '
+                         'N - 1'.format(text))
+
+    return index, count
+
+
+def shard_of(miniature_id, count):
+    """
+    The shard (out of count) that a miniature belongs to.
+    """
+    digest = hashlib.sha1(str(int(miniature_id)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def in_shard(miniature_id, shard):
+    """
+    True if a miniature belongs to a shard (all of them belong to no shard).
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(miniature_id, count) == index
+
+
+def shard_path(path, shard):
+    """
+    Path of the output of a shard, next to the regular output (the same
+    path, if no shard).
+    """
+    if shard is None:
+        return path
+    index, count = shard
+    return path.with_name('{}.shard-{}-of-{}{}'.format(path.stem, index,
+                                                      count, path.suffix))
+
+
+def shard_paths(path, count):
+    """
+    Paths of the outputs of all the shards of a regular output, failing if
+    any of them is missing.
+    """
+    paths = [shard_path(path, (index, count)) for index in range(count)]
+    missing = [str(path) for path in paths if not path.exists()]
+    if missing:
+        raise FileNotFoundError('Missing shard outputs: {}'.format(
+            ', '.join(missing)))
+    return paths
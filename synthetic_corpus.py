@@ -0,0 +1,144 @@
+"""
+Generate a synthetic corpus with the same layout as the data dir: a metadata
+csv, jpeg pictures and tagged objects json files. Useful for benchmarks.
+
+Usage:
+    synthetic_corpus.py CORPUS_DIR [options]
+
+Options:
+    CORPUS_DIR              where to create the corpus.
+    --miniatures=N          amount of miniatures in the csv [default: 16500].
+    --pictures=N            how many of them get a picture file [default: 500].
+    --tagged=N              how many of the ones with pictures get tagged
+                            objects [default: 300].
+    --picture-size=N        longest side of the pictures, in pixels
+                            [default: 1200].
+    --seed=SEED             seed for the random contents [default: 0].
+"""
+import json
+from pathlib import Path
+
+import attr
+from docopt import docopt
+import numpy as np
+from PIL import Image
+
+
+OBJECT_NAMES = ['sword', 'shield', 'crown', 'miter', 'spear', 'horse']
+TAGS = OBJECT_NAMES + [
+    'knight', 'mail', 'coat of plates', 'clothes', 'violent cleric',
+    'kettle hat', 'falchion', 'round shield', 'david', 'goliath', 'city',
+    'infantry', 'king', 'castle', 'mace', 'chapel de fer',
+]
+
+
+@attr.s
+class CorpusSpec:
+    miniatures = attr.ib(default=16500)
+    pictures = attr.ib(default=500)
+    tagged = attr.ib(default=300)
+    picture_size = attr.ib(default=1200)
+    seed = attr.ib(default=0)
+
+
+def metadata_line(random_generator, manuscript_id, miniature_id, file_name):
+    """
+    Build a line of the metadata csv, in the format of the real one (some
+    miniatures lack their end year, and have between 0 and 8 tags).
+    """
+    start_year = int(random_generator.integers(1000, 1500))
+    end_year = start_year + int(random_generator.integers(0, 60))
+    if random_generator.random() < 0.01:
+        end_year = None
+
+    tags_count = int(random_generator.integers(0, 9))
+    tags = random_generator.choice(TAGS, tags_count, replace=False).tolist()
+
+    fields = [manuscript_id, miniature_id, file_name, start_year, end_year]
+    return ','.join(str(field) for field in fields + tags)
+
+
+def synthetic_picture(random_generator, width, height):
+    """
+    Build a picture that compresses like a real one: smooth color regions plus
+    some grain, instead of pure noise.
+    """
+    coarse = random_generator.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    picture = Image.fromarray(coarse).resize((width, height), Image.BICUBIC)
+
+    grain = random_generator.integers(-12, 13, (height, width, 3))
+    pixels = np.clip(np.asarray(picture, dtype=np.int16) + grain, 0, 255)
+
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def synthetic_objects(random_generator, width, height):
+    """
+    Build the serialized tagged objects of a miniature (1 to 4 rectangles of
+    random objects, each covering between 5% and 40% of each side).
+    """
+    objects = []
+    for _ in range(int(random_generator.integers(1, 5))):
+        name = str(random_generator.choice(OBJECT_NAMES))
+        object_width = int(width * random_generator.uniform(0.05, 0.4))
+        object_height = int(height * random_generator.uniform(0.05, 0.4))
+        from_x = int(random_generator.integers(0, width - object_width))
+        from_y = int(random_generator.integers(0, height - object_height))
+        objects.append((name, [from_x, from_y,
+                               from_x + object_width,
+                               from_y + object_height]))
+    return objects
+
+
+def generate(corpus_dir, spec):
+    """
+    Generate the corpus in a dir, returning its data dir.
+    """
+    random_generator = np.random.default_rng(spec.seed)
+
+    data_dir = Path(corpus_dir)
+    pictures_dir = data_dir / 'pictures'
+    objects_dir = data_dir / 'objects'
+    for directory in (pictures_dir, objects_dir,
+                      data_dir / 'object_picture_sets'):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    lines = []
+    for number in range(spec.miniatures):
+        manuscript_id = 3900 + number // 20
+        miniature_id = 10000 + number
+        file_name = '{}-{}.jpg'.format(manuscript_id, number % 20 + 1)
+        lines.append(metadata_line(random_generator, manuscript_id,
+                                   miniature_id, file_name))
+
+        if number < spec.pictures:
+            width = int(spec.picture_size *
+                        random_generator.uniform(0.6, 1))
+            height = int(spec.picture_size *
+                         random_generator.uniform(0.6, 1))
+            picture = synthetic_picture(random_generator, width, height)
+            picture.save(str(pictures_dir / file_name), quality=90)
+
+            if number < spec.tagged:
+                objects = synthetic_objects(random_generator, width, height)
+                objects_path = objects_dir / '{}.json'.format(miniature_id)
+                with objects_path.open('w') as objects_file:
+                    json.dump(objects, objects_file)
+
+    with (data_dir / 'miniatures_metadata.csv').open('w') as metadata_file:
+        metadata_file.write('\n'.join(lines) + '\n')
+
+    return data_dir
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    spec = CorpusSpec(
+        miniatures=int(opts['--miniatures']),
+        pictures=int(opts['--pictures']),
+        tagged=int(opts['--tagged']),
+        picture_size=int(opts['--picture-size']),
+        seed=int(opts['--seed']),
+    )
+
+    generate(opts['CORPUS_DIR'], spec)
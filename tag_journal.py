@@ -0,0 +1,224 @@
+"""
+Write-behind persistence of the objects tagged in the tagger.
+
+Each change is appended to a journal file (one json line with all the objects
+of the miniature after the change, plus the object being tagged), which is
+cheap enough to do in the UI thread. A background thread fsyncs the journal in
+batches, then writes the changed miniatures into their json files and the
+objects store, saves the resume points (the last tagged miniature id of each
+object), and empties the journal once everything in it was applied.
+
+If the tagger dies before that, the journal is replayed the next time it's
+opened, so no tags are lost. If saving fails in the background, the records
+are kept to be retried, and the error is raised by the next record or close,
+so the tagger notices.
+"""
+import json
+import os
+import threading
+
+from core import TaggedObject, save_raw_objects
+import settings
+
+
+def load_resume_points():
+    """
+    Read the last tagged miniature of each object. Old files stored the
+    position of the miniature in the list instead of its id, those come back
+    as {'index': position}.
+    """
+    if not settings.LAST_TAGGED_OBJECTS_PATH.exists():
+        return {}
+
+    with settings.LAST_TAGGED_OBJECTS_PATH.open() as last_tagged_file:
+        resume_points = json.load(last_tagged_file)
+
+    return {object_name: (point if isinstance(point, dict)
+                          else {'index': point})
+            for object_name, point in resume_points.items()}
+
+
+def save_resume_points(resume_points):
+    """
+    Save the last tagged miniature of each object (atomically).
+    """
+    path = settings.LAST_TAGGED_OBJECTS_PATH
+    partial_path = path.with_name(path.name + '.part')
+    with partial_path.open('w') as last_tagged_file:
+        json.dump(resume_points, last_tagged_file)
+    partial_path.replace(path)
+
+
+def read_journal(journal_path):
+    """
+    Read the records of a journal, ignoring a last line left incomplete by a
+    crash.
+    """
+    records = []
+    if journal_path.exists():
+        with journal_path.open() as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    return records
+
+
+class TagJournal:
+    def __init__(self, journal_path=None, flush_interval=None):
+        if journal_path is None:
+            journal_path = settings.TAG_JOURNAL_PATH
+        if flush_interval is None:
+            flush_interval = settings.TAG_JOURNAL_FLUSH_INTERVAL
+
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.resume_points = load_resume_points()
+
+        # pending records, and the latest objects of their miniatures (which
+        # aren't in the objects store yet)
+        self.pending = []
+        self.latest_objects = {}
+        self.condition = threading.Condition()
+        self.closing = False
+        # the error of the last flush, if it failed
+        self.error = None
+
+        self.apply(read_journal(journal_path))
+
+        self.journal_file = journal_path.open('a')
+        self.journal_file.truncate(0)
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def apply(self, records):
+        """
+        Write the objects of the journal records into the json files and the
+        objects store (only the last record of each miniature matters), and
+        update the resume points.
+        """
+        if not records:
+            return
+
+        last_objects = {}
+        for record in records:
+            last_objects[record['miniature_id']] = record['objects']
+            self.resume_points[record['object_name']] = {
+                'miniature_id': record['miniature_id']}
+
+        for miniature_id, raw_objects in last_objects.items():
+            save_raw_objects(miniature_id, raw_objects)
+        save_resume_points(self.resume_points)
+
+    def record(self, miniature, object_name):
+        """
+        Journal the current objects of a miniature, after tagging an object in
+        it. Returns right after appending to the journal, the rest happens in
+        the background. Raises (after journaling) if the background saving is
+        failing.
+        """
+        record = {
+            'miniature_id': miniature.miniature_id,
+            'object_name': object_name,
+            'objects': [tagged_object.serialize()
+                        for tagged_object in miniature.objects],
+        }
+        with self.condition:
+            self.journal_file.write(json.dumps(record) + '\n')
+            self.journal_file.flush()
+            self.pending.append(record)
+            self.latest_objects[miniature.miniature_id] = record['objects']
+            self.raise_error()
+
+    def raise_error(self):
+        """
+        Raise the error of the last flush, if it failed (must hold the
+        condition).
+        """
+        if self.error is not None:
+            raise RuntimeError('Saving the tagged objects failed, they are '
+                               'kept in the journal at {}'.format(
+                                   self.journal_path)) from self.error
+
+    def load_objects(self, miniature):
+        """
+        Load the objects of a miniature, including the changes that weren't
+        flushed into the objects store yet.
+        """
+        with self.condition:
+            raw_objects = self.latest_objects.get(miniature.miniature_id)
+
+        if raw_objects is None:
+            miniature.load_objects()
+        else:
+            miniature.objects = [
+                TaggedObject.deserialize(raw_object_data)
+                for raw_object_data in raw_objects]
+
+    def resume_point(self, object_name):
+        with self.condition:
+            return self.resume_points.get(object_name)
+
+    def flush(self):
+        """
+        Make the journal durable (one fsync for all the pending records),
+        apply its records, and empty it if nothing new arrived meanwhile. If
+        it fails, the records stay pending (to be retried), and the error is
+        remembered.
+        """
+        with self.condition:
+            records = self.pending
+            self.pending = []
+
+        if not records:
+            return
+
+        try:
+            with self.condition:
+                os.fsync(self.journal_file.fileno())
+            self.apply(records)
+        except Exception as err:
+            with self.condition:
+                self.pending = records + self.pending
+                self.error = err
+            return
+
+        with self.condition:
+            self.error = None
+            for record in records:
+                miniature_id = record['miniature_id']
+                if self.latest_objects.get(miniature_id) is record['objects']:
+                    del self.latest_objects[miniature_id]
+            if not self.pending:
+                self.journal_file.truncate(0)
+
+    def flush_loop(self):
+        """
+        Flush the journal every flush_interval seconds (so records arriving
+        meanwhile share a single fsync), until it's closed.
+        """
+        while True:
+            with self.condition:
+                if not self.closing:
+                    self.condition.wait(self.flush_interval)
+                closing = self.closing
+
+            self.flush()
+            if closing:
+                return
+
+    def close(self):
+        """
+        Flush everything still pending, and close the journal. Raises if that
+        failed (the records are still in the journal, and are replayed the next
+        time it's opened).
+        """
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.flusher.join()
+        self.journal_file.close()
+
+        with self.condition:
+            self.raise_error()
@@ -10,183 +10,253 @@ Options:
 During tagging, you can:
     - click twice in the picture, to generate a tagged rectangle (and a preview will be available at preview.png)
     - press backspace to undo the last action (either click or tagged object)
-    - press left and right arrows to move through pictures
-      (WARNING: don't do it too fast, it will crash TK)
+    - press left and right arrows to move through pictures (the next and
+      previous ones are decoded in the background, downscaled for display)
     - press escape to quit
+
+Objects already tagged in the picture are outlined (in green the ones of the
+object being tagged, in yellow the rest).
 """
-import sys
-import json
+from concurrent.futures import ThreadPoolExecutor
+import time
 
-import matplotlib.image as mpimg
 from matplotlib import pyplot as plt
 from matplotlib.patches import Rectangle
+import numpy as np
 from PIL import Image
 
 import attr
 from docopt import docopt
 
-from core import Miniature, TaggedObject
+from core import TaggedObject
+from miniature_table import MiniatureTable
+from picture_cache import PictureCache
 import settings
+from tag_journal import TagJournal
 
 
 @attr.s
 class TaggingStatus:
     current_index = attr.ib(default=0)
+    miniature = attr.ib(default=None)
+    using_real_picture = attr.ib(default=False)
     last_click = attr.ib(default=None)
-    keep_tagging = attr.ib(default=True)
-    last_tagged = attr.ib(default={})
-
-    def load_last_tagged(self):
-        """
-        Read (if present) the file that remembers which miniature was last
-        tagged for each object.
-        """
-        if settings.LAST_TAGGED_OBJECTS_PATH.exists():
-            with settings.LAST_TAGGED_OBJECTS_PATH.open() as last_tagged_file:
-                self.last_tagged = json.load(last_tagged_file)
-        else:
-            self.last_tagged = {}
+    background = attr.ib(default=None)
+    last_redraw = attr.ib(default=0)
+
 
-    def save_last_tagged(self):
-        """
-        Save a file with information regarding the last tagged miniature for
-        each object.
-        """
-        with settings.LAST_TAGGED_OBJECTS_PATH.open('w') as last_tagged_file:
-            json.dump(self.last_tagged, last_tagged_file)
+def save_preview(picture_path, rectangle):
+    """
+    Save a preview of a tagged object, cropped from the full size picture.
+    """
+    with Image.open(str(picture_path)) as picture:
+        window = picture.crop(rectangle)
+        window.save(str(settings.OBJECT_PREVIEW_PATH))
 
 
 def tagging_loop(object_name, maximized=True):
     """
     Loop where the user interacts with the miniatures by tagging objects in them.
+
+    A single figure is used for the whole session, swapping the picture shown
+    in it. The selection and the outlines of the tagged objects are animated
+    artists, blitted over a cached background with the picture, so dragging a
+    selection never redraws the picture itself.
     """
     status = TaggingStatus()
-    status.load_last_tagged()
-
-    if object_name in status.last_tagged:
-        status.current_index = status.last_tagged[object_name]
-
-    miniatures = list(Miniature.all())
-
-    # tag objects until the user quits
-    while status.keep_tagging:
-        miniature = miniatures[status.current_index]
-        miniature.load_objects()
-
-        def on_click(event):
-            if event.button == 1:
-                x = int(round(event.xdata))
-                y = int(round(event.ydata))
-
-                if status.last_click:
-                    last_x, last_y = status.last_click
-
-                    # for a rectangle with the two corners, but we don't know
-                    # which one is on the top left, etc. Sort them:
-                    from_x = min(x, last_x)
-                    from_y = min(y, last_y)
-                    to_x = max(x, last_x)
-                    to_y = max(y, last_y)
-
-                    # save a preview
-                    window = picture.copy()
-                    window = window.crop((from_x, from_y, to_x, to_y))
-                    window.save(str(settings.OBJECT_PREVIEW_PATH))
-
-                    # store rectangle
-                    tagged_object = TaggedObject(
-                        name=object_name,
-                        position=[from_x, from_y, to_x, to_y]
-                    )
-                    miniature.objects.append(tagged_object)
-                    miniature.save_objects()
-
-                    # infor the user
-                    print('Tagged', tagged_object, 'in', miniature)
-
-                    status.last_tagged[object_name] = status.current_index
-                    status.save_last_tagged()
-
-                    # reset clicks
-                    status.last_click = None
-                else:
-                    # first click, store and wait for the second click
-                    status.last_click = x, y
-                    print('Waiting for second click...')
-
-        def on_move(event):
-            if status.last_click and event.xdata is not None and event.ydata is not None:
-                rect_x, rect_y = status.last_click
-                width, height = event.xdata - rect_x, event.ydata - rect_y
-                rect.set_width(width)
-                rect.set_height(height)
-                rect.set_xy((rect_x, rect_y))
-                rect.figure.canvas.draw()
-
-        def on_key(event):
-            if event.key == 'escape':
-                # stop tagging
-                print('User is tired of tagging')
-                status.keep_tagging = False
-                plt.close('all')
-            elif event.key == 'right':
-                # next picture
-                if status.current_index < len(miniatures) - 1:
-                    status.current_index += 1
-                    plt.close('all')
-            elif event.key == 'left':
-                # previous picture
-                if status.current_index > 0:
-                    status.current_index -= 1
-                    plt.close('all')
-            elif event.key == 'backspace':
-                # clear selection
-                rect.set_width(0.1)
-                rect.set_height(0.1)
-                rect.figure.canvas.draw()
-
-                if status.last_click:
-                    # reset clicks
-                    status.last_click = None
-                    print('Undo click')
-                else:
-                    print("Can't undo a saved tag")
-
-        # show picture and map events
-        try:
-            picture_path = str(miniature.picture_path)
-            picture = miniature.open_picture()
-            using_real_picture = True
-        except:
-            picture_path = str(settings.EMPTY_PICTURE_PATH)
-            picture = Image.open(picture_path)
-            using_real_picture = False
-
-        ax = plt.imshow(mpimg.imread(picture_path))
-
-        fig = ax.get_figure()
-        fig.canvas.set_window_title(str(miniature))
-
-        fig.canvas.mpl_connect('key_press_event', on_key)
-        if using_real_picture:
-            fig.canvas.mpl_connect('motion_notify_event', on_move)
-            fig.canvas.mpl_connect('button_press_event', on_click)
-
-            rect = Rectangle((0, 0), 0, 0, linewidth=1, edgecolor='r', facecolor='none')
-            selection = fig.add_subplot(111)
-            selection.add_patch(rect)
-
+    # replays the changes a previous session couldn't save, if any
+    journal = TagJournal()
+    previews = ThreadPoolExecutor(max_workers=1)
+
+    # miniatures are built from the table only when shown
+    miniatures = MiniatureTable()
+    pictures = PictureCache()
+
+    resume_point = journal.resume_point(object_name)
+    if resume_point is not None:
+        if 'miniature_id' in resume_point:
+            row = miniatures.rows_of([resume_point['miniature_id']])[0]
+            status.current_index = max(int(row), 0)
+        else:
+            status.current_index = min(resume_point['index'],
+                                       len(miniatures) - 1)
+
+    fig, ax = plt.subplots()
+    image = ax.imshow(np.zeros((1, 1, 3), dtype=np.uint8))
+    selection = Rectangle((0, 0), 0, 0, linewidth=1, edgecolor='r',
+                          facecolor='none', animated=True, visible=False)
+    ax.add_patch(selection)
+    outlines = []
+
+    def draw_animated():
+        for outline in outlines:
+            ax.draw_artist(outline)
+        ax.draw_artist(selection)
+
+    def blit():
+        if status.background is not None:
+            fig.canvas.restore_region(status.background)
+            draw_animated()
+            fig.canvas.blit(ax.bbox)
+
+    def add_outline(tagged_object):
+        from_x, from_y, to_x, to_y = tagged_object.position
+        color = 'lime' if tagged_object.name == object_name else 'yellow'
+        outline = Rectangle((from_x, from_y), to_x - from_x, to_y - from_y,
+                            linewidth=1, edgecolor=color, facecolor='none',
+                            animated=True)
+        ax.add_patch(outline)
+        outlines.append(outline)
+
+    def show(index):
+        status.current_index = index
+        miniature = miniatures[index]
+        journal.load_objects(miniature)
+
+        # show a downscaled picture, but keep the axes in the coordinates of
+        # the original one, so clicks map back to its full resolution
+        display_picture = pictures.get(miniature)
+        width, height = display_picture.original_size
+        image.set_data(display_picture.pixels)
+        image.set_extent((0, width, height, 0))
+        ax.set_xlim(0, width)
+        ax.set_ylim(height, 0)
+
+        neighbours = range(
+            max(index - settings.PREFETCH_DISTANCE, 0),
+            min(index + settings.PREFETCH_DISTANCE + 1, len(miniatures)))
+        pictures.prefetch(miniatures[neighbour] for neighbour in neighbours)
+
+        status.miniature = miniature
+        status.using_real_picture = display_picture.using_real_picture
         status.last_click = None
+        selection.set_visible(False)
+
+        for outline in outlines:
+            outline.remove()
+        outlines.clear()
+        for tagged_object in miniature.objects:
+            add_outline(tagged_object)
+
+        fig.canvas.manager.set_window_title(str(miniature))
+        fig.canvas.draw_idle()
+
+    def on_draw(event):
+        # the picture changed (or the window was resized), cache it again
+        status.background = fig.canvas.copy_from_bbox(ax.bbox)
+        draw_animated()
+
+    def on_click(event):
+        if (event.button != 1 or event.inaxes is not ax or
+                not status.using_real_picture):
+            return
+
+        x = int(round(event.xdata))
+        y = int(round(event.ydata))
+
+        if status.last_click:
+            last_x, last_y = status.last_click
+
+            # for a rectangle with the two corners, but we don't know
+            # which one is on the top left, etc. Sort them:
+            from_x = min(x, last_x)
+            from_y = min(y, last_y)
+            to_x = max(x, last_x)
+            to_y = max(y, last_y)
+
+            # store rectangle (it's saved in the background)
+            tagged_object = TaggedObject(
+                name=object_name,
+                position=[from_x, from_y, to_x, to_y]
+            )
+            miniature = status.miniature
+            miniature.objects.append(tagged_object)
+            journal.record(miniature, object_name)
+
+            previews.submit(save_preview, miniature.picture_path,
+                            tagged_object.position)
+
+            # infor the user
+            print('Tagged', tagged_object, 'in', miniature)
+
+            # reset clicks
+            status.last_click = None
+            selection.set_visible(False)
+            add_outline(tagged_object)
+            blit()
+        else:
+            # first click, store and wait for the second click
+            status.last_click = x, y
+            selection.set_bounds(x, y, 0, 0)
+            selection.set_visible(True)
+            blit()
+            print('Waiting for second click...')
+
+    def on_move(event):
+        if (status.last_click is None or event.inaxes is not ax or
+                event.xdata is None or event.ydata is None):
+            return
+
+        # skip motion events arriving faster than the display can show them
+        now = time.monotonic()
+        if now - status.last_redraw < settings.SELECTION_REDRAW_INTERVAL:
+            return
+        status.last_redraw = now
+
+        rect_x, rect_y = status.last_click
+        selection.set_bounds(rect_x, rect_y,
+                             event.xdata - rect_x, event.ydata - rect_y)
+        blit()
+
+    def on_key(event):
+        if event.key == 'escape':
+            # stop tagging
+            print('User is tired of tagging')
+            plt.close(fig)
+        elif event.key == 'right':
+            # next picture
+            if status.current_index < len(miniatures) - 1:
+                show(status.current_index + 1)
+        elif event.key == 'left':
+            # previous picture
+            if status.current_index > 0:
+                show(status.current_index - 1)
+        elif event.key == 'backspace':
+            # clear selection
+            selection.set_visible(False)
+            blit()
+
+            if status.last_click:
+                # reset clicks
+                status.last_click = None
+                print('Undo click')
+            else:
+                print("Can't undo a saved tag")
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    fig.canvas.mpl_connect('key_press_event', on_key)
+    fig.canvas.mpl_connect('motion_notify_event', on_move)
+    fig.canvas.mpl_connect('button_press_event', on_click)
+
+    show(status.current_index)
+
+    if maximized:
+        mng = plt.get_current_fig_manager()
+        mng.resize(*mng.window.maxsize())
 
-        if maximized:
-            mng = plt.get_current_fig_manager()
-            mng.resize(*mng.window.maxsize())
+    # tag objects until the user quits
+    plt.show(block=True)
 
-        plt.show(block=True)
+    pictures.close()
+    previews.shutdown()
+    journal.close()
 
 
-if __name__ == '__main__':
-    opts = docopt(__doc__)
+def run(opts):
     object_name = opts['OBJECT_NAME']
 
     tagging_loop(object_name)
+
+
+if __name__ == '__main__':
+    run(docopt(__doc__))
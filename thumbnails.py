@@ -0,0 +1,146 @@
+"""
+Pyramid of downscaled versions of the miniatures pictures (one dir per level,
+named after the shortest side of the pictures in it), so consumers that need
+small pictures don't have to decode the big originals. Levels are stored
+losslessly (png), so they only add the resizing to the original pixels.
+
+Each pyramid has a marker with the size and modification time of the original
+it was built from, and its levels (none, if the original is smaller than all
+of them). Pyramids whose original changed (for example, downloaded again) are
+ignored until they are rebuilt.
+"""
+import json
+
+from PIL import Image
+
+import settings
+
+
+def thumbnail_path(file_name, level):
+    """
+    Path of the thumbnail of a picture at a given level.
+    """
+    return (settings.THUMBNAILS_DIR / str(level) /
+            (file_name.rsplit('.', 1)[0] + '.png'))
+
+
+def marker_path(file_name):
+    """
+    Path of the marker of the pyramid of a picture.
+    """
+    return settings.THUMBNAILS_DIR / 'sources' / (file_name + '.json')
+
+
+def source_signature(picture_path):
+    """
+    Size and modification time of an original picture, which change when it's
+    replaced.
+    """
+    stat = picture_path.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def current_levels(picture_path, file_name):
+    """
+    The levels of the pyramid of a picture, if it was built from the current
+    original and all its thumbnails are present (None otherwise).
+    """
+    path = marker_path(file_name)
+    if not path.exists():
+        return None
+
+    try:
+        with path.open() as marker_file:
+            marker = json.load(marker_file)
+    except ValueError:
+        return None
+
+    if marker['source'] != source_signature(picture_path):
+        return None
+    if not all(thumbnail_path(file_name, level).exists()
+               for level in marker['levels']):
+        return None
+    return marker['levels']
+
+
+def remove_pyramid(file_name):
+    """
+    Remove the marker and thumbnails of a picture (also the jpeg thumbnails
+    of older pyramids, which had the name of the original).
+    """
+    paths = [marker_path(file_name)]
+    for level in settings.THUMBNAIL_LEVELS:
+        paths.append(thumbnail_path(file_name, level))
+        paths.append(settings.THUMBNAILS_DIR / str(level) / file_name)
+
+    for path in paths:
+        if path.exists():
+            path.unlink()
+
+
+def build_pyramid(picture_path, file_name):
+    """
+    Build the thumbnails of a picture, each level downscaled from the previous
+    (bigger) one, and decoding the original at a reduced scale when possible.
+    Levels not smaller than the original are skipped. Pyramids already built
+    from the current original are kept. Returns how many thumbnails were
+    built, or None if the pyramid was already current.
+    """
+    if current_levels(picture_path, file_name) is not None:
+        return None
+
+    remove_pyramid(file_name)
+    source = source_signature(picture_path)
+    levels = sorted(settings.THUMBNAIL_LEVELS, reverse=True)
+
+    built = []
+    with Image.open(str(picture_path)) as picture:
+        picture.draft(picture.mode, (levels[0], levels[0]))
+        current = picture
+        if current.mode not in ('RGB', 'L'):
+            current = current.convert('RGB')
+
+        for level in levels:
+            shortest_size = min(current.size)
+            if level >= shortest_size:
+                continue
+
+            width, height = current.size
+            current = current.resize(
+                (max(round(width * level / shortest_size), 1),
+                 max(round(height * level / shortest_size), 1)),
+                Image.LANCZOS)
+
+            path = thumbnail_path(file_name, level)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            partial_path = path.with_name(path.name + '.part')
+            current.save(str(partial_path), format='PNG')
+            partial_path.replace(path)
+            built.append(level)
+
+    # written last, so an interrupted build is done again
+    path = marker_path(file_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(path.name + '.part')
+    with partial_path.open('w') as marker_file:
+        json.dump({'source': source, 'levels': built}, marker_file)
+    partial_path.replace(path)
+
+    return len(built)
+
+
+def open_at_least(picture_path, file_name, min_size):
+    """
+    Open the cheapest version of a picture whose shortest side has at least
+    min_size pixels: the smallest thumbnail that is big enough (if the
+    pyramid is current), or else the original, decoded at a reduced scale when
+    the format allows it (jpeg).
+    """
+    levels = current_levels(picture_path, file_name) or []
+    for level in sorted(levels):
+        if level >= min_size:
+            return Image.open(str(thumbnail_path(file_name, level)))
+
+    picture = Image.open(str(picture_path))
+    picture.draft(picture.mode, (min_size, min_size))
+    return picture
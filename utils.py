@@ -1,7 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+import os
+
 import numpy as np
-import pandas as pd
 from PIL import Image
 
+import instrumentation
+from instrumentation import profiler
+
 
 def input_columns_names(picture_size):
     """
@@ -16,35 +23,134 @@ def input_columns_names(picture_size):
     return input_columns
 
 
-def get_picture_data(picture_path, picture_size, input_columns):
+def get_picture_pixels_sizes(picture_path, picture_sizes):
+    """
+    Open one particular picture, decoding it only once, and resize it to
+    several sizes. Returns a list with the pixels at each size, as
+    (picture_size, picture_size, 3) uint8 arrays.
+    """
+    with instrumentation.stage('decode'):
+        picture = Image.open(picture_path)
+        # let jpegs decode at a reduced scale when much bigger than needed
+        biggest_size = max(picture_sizes)
+        picture.draft(picture.mode, (biggest_size, biggest_size))
+        picture.load()
+    if profiler.enabled:
+        instrumentation.count('decode', items=1,
+                              bytes_read=os.path.getsize(str(picture_path)))
+
+    all_pixels = []
+    for picture_size in picture_sizes:
+        with instrumentation.stage('resize'):
+            resized = picture.resize((picture_size, picture_size),
+                                     Image.LANCZOS)
+
+            # convert grayscale (and any other mode) ones to rgb
+            if resized.mode != 'RGB':
+                resized = resized.convert('RGB')
+
+            all_pixels.append(np.asarray(resized))
+
+    return all_pixels
+
+
+def get_picture_pixels(picture_path, picture_size):
+    """
+    Open and resize one particular picture, returning its pixels as a
+    (picture_size, picture_size, 3) uint8 array.
+    """
+    return get_picture_pixels_sizes(picture_path, [picture_size])[0]
+
+
+def iter_pictures_pixels_sizes(picture_paths, picture_sizes, workers=None):
     """
-    Extract pixels from one particular picture.
+    Yield the pixels of each picture at several sizes (as
+    get_picture_pixels_sizes does), in order. If workers is specified, the
+    pictures are decoded and resized by a pool of processes (0 means one per
+    cpu).
     """
-    picture = Image.open(picture_path)
-    picture = picture.resize((picture_size, picture_size), Image.ANTIALIAS)
+    picture_sizes = list(picture_sizes)
 
-    # convert grayscale ones to rgb
-    if picture.mode == 'L':
-        picture = picture.convert('RGB')
+    if workers is None:
+        yield from map(get_picture_pixels_sizes, picture_paths,
+                       repeat(picture_sizes))
+    else:
+        extract = partial(instrumentation.call_collecting, profiler.enabled,
+                          get_picture_pixels_sizes)
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            results = executor.map(extract, picture_paths,
+                                   repeat(picture_sizes), chunksize=32)
+            yield from instrumentation.merge_collected(results)
 
-    picture_data = np.array(list(zip(*picture.getdata())))
-    picture_data = picture_data.reshape(len(input_columns))
 
-    return picture_data
+def tensor_sidecar_path(tensor_path):
+    """
+    Path of the csv file describing the samples of a tensor file.
+    """
+    return tensor_path.with_suffix('.csv')
 
 
-def get_dataframe_from_dir(pictures_dir, picture_size):
+class TensorWriter:
     """
-    Create a pandas dataframe from a dir of picture files.
+    Incrementally fill a (N, picture_size, picture_size, 3) uint8 .npy file,
+    in place, so the whole set never needs to fit in memory. The file is
+    preallocated with a capacity, and shrunk on close if fewer pictures were
+    written.
     """
-    input_columns = input_columns_names(picture_size)
-    sorted_picture_paths = list(sorted(pictures_dir.glob('*.jpg')))
+    def __init__(self, tensor_path, capacity, picture_size):
+        self.tensor_path = tensor_path
+        self.partial_path = tensor_path.with_name(tensor_path.name + '.part')
+        self.tensor = np.lib.format.open_memmap(
+            str(self.partial_path), mode='w+', dtype=np.uint8,
+            shape=(capacity, picture_size, picture_size, 3))
+        self.count = 0
+
+    def extend(self, pixels):
+        """
+        Append a batch of pictures, shaped (n, picture_size, picture_size, 3).
+        """
+        self.tensor[self.count:self.count + len(pixels)] = pixels
+        self.count += len(pixels)
+
+    def close(self, sidecar):
+        """
+        Finish writing the tensor file, and save the sidecar dataframe (one
+        row per written picture) next to it.
+        """
+        self.tensor.flush()
 
-    def extract_all_data():
-        for picture_path in sorted_picture_paths:
-            yield get_picture_data(picture_path, picture_size, input_columns)
+        if self.count < len(self.tensor):
+            shrunk_path = self.partial_path.with_suffix('.shrunk')
+            shrunk = np.lib.format.open_memmap(
+                str(shrunk_path), mode='w+', dtype=np.uint8,
+                shape=(self.count,) + self.tensor.shape[1:])
+            for start in range(0, self.count, 1024):
+                end = min(start + 1024, self.count)
+                shrunk[start:end] = self.tensor[start:end]
+            shrunk.flush()
+            del shrunk
+            shrunk_path.replace(self.partial_path)
+
+        del self.tensor
+        self.partial_path.replace(self.tensor_path)
+        if profiler.enabled:
+            instrumentation.count(
+                'write_tensor', items=self.count,
+                bytes_written=os.path.getsize(str(self.tensor_path)))
+
+        sidecar.to_csv(str(tensor_sidecar_path(self.tensor_path)),
+                       index=False)
+
+
+def load_tensor(tensor_path):
+    """
+    Open a tensor file written by TensorWriter, returning its pixels as a
+    read only memory mapped array (nothing is read until it's sliced) and its
+    sidecar dataframe.
+    """
+    import pandas as pd
 
-    pictures_df = pd.DataFrame(extract_all_data(), columns=input_columns)
-    pictures_df['file'] = [p.name for p in sorted_picture_paths]
+    pixels = np.load(str(tensor_path), mmap_mode='r')
+    sidecar = pd.read_csv(str(tensor_sidecar_path(tensor_path)))
 
-    return pictures_df
+    return pixels, sidecar